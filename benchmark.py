@@ -0,0 +1,677 @@
+"""Offline latency benchmark for Talko.
+
+Runs diagnostic tests and lessons headlessly against a local stand-in server for Anthropic,
+Deepgram (prerecorded and live) and Google TTS, with synthetic or recorded WAV input in place
+of the microphone and a real-time null audio output. Reports p50/p95 latency per stage and per turn,
+and can compare against a saved baseline to catch latency regressions.
+
+    python benchmark.py --runs 5 --output latency.json
+    python benchmark.py --runs 5 --baseline latency.json  # exits 1 on a p95 regression
+"""
+import base64
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Literal
+
+import numpy as np
+import soundfile as sf
+from tap import Tap
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+STAGES = ("capture", "stt", "llm", "llm_first_text", "tts", "playback", "response")
+
+@dataclass
+class StubConfig:
+    """Latency and payload sizes of the stand-in services."""
+    llm_latency: float = 0.5  # Seconds before Claude's first byte
+    llm_words: int = 60  # Words per tutor reply
+    llm_words_per_second: float = 40.0  # Streaming speed of replies
+    stt_latency: float = 0.3  # Seconds Deepgram takes to return a transcript
+    tts_latency: float = 0.25  # Seconds Google TTS takes per request
+    segment_seconds: float = 0.5  # Seconds of audio in each synthesized mp3 segment
+    diagnostic_questions: int = 3  # Learner answers before the evaluator assigns a level
+    lesson_turns: int = 4  # Learner answers before the tutor ends the lesson
+    failure_rate: float = 0.0  # Fraction of service requests that fail with a 503
+    slow_rate: float = 0.0  # Fraction of service requests delayed by --slow_latency (tail latency)
+    slow_latency: float = 5.0  # Extra seconds a slow request takes
+    batch_latency: float = 2.0  # Seconds before a Message Batch ends
+
+def tone_mp3(seconds, sample_rate=24000):
+    """A quiet tone encoded as mp3, standing in for a Google TTS segment."""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    encoded = io.BytesIO()
+    sf.write(encoded, (0.1 * np.sin(2 * np.pi * 220 * t)).astype(np.float32), sample_rate, format="MP3")
+    return encoded.getvalue()
+
+def filler_text(words, seed):
+    """Deterministic sentences of roughly `words` words, so replies split into several spoken sentences."""
+    rng = random.Random(seed)
+    vocabulary = ["hola", "bien", "casa", "mercado", "comer", "libro", "amigo", "tiempo", "ciudad", "agua", "grande", "hoy"]
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(6, 12))
+        sentences.append(" ".join(rng.choice(vocabulary) for _ in range(length)).capitalize() + ".")
+        words -= length
+    return " ".join(sentences)
+
+class StubServer(ThreadingHTTPServer):
+    """One local HTTP server standing in for every service Talko talks to."""
+    daemon_threads = True
+    request_queue_size = 1024  # Load tests open hundreds of connections at once
+
+    def __init__(self, config):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.config = config
+        self.requests = defaultdict(int)
+        self.batches = {}  # Message Batch id -> when it ends, its JSONL results and request counts
+        self.tts_audio = base64.b64encode(tone_mp3(config.segment_seconds)).decode()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def tutor_reply(self, body):
+        """Pick a reply that moves the session along like the real prompts would."""
+        system = body.get("system", "")
+        if isinstance(system, list):
+            system = " ".join(block.get("text", "") for block in system)
+        learner_turns = sum(1 for message in body["messages"] if message["role"] == "user") - 1
+        text = filler_text(self.config.llm_words, seed=len(body["messages"]))
+        if "topic generator" in system:
+            return "The words suggest shopping for food. FINAL TOPIC: At the market"
+        if "detailed update on the user's overall progress" in system:
+            return ("<overall_progress>Steady progress.</overall_progress>\n"
+                    "<language_goals>Practice past tenses.</language_goals>\n"
+                    "<proximal_development>Short conversations about daily life.</proximal_development>")
+        if "summarize language lessons" in system:
+            return "The student practiced greetings and food vocabulary."
+        if "proficiency evaluator" in system and learner_turns >= self.config.diagnostic_questions:
+            return f"{text} Based on your answers, your proficiency level 5 out of 10."
+        if "language tutor" in system and learner_turns >= self.config.lesson_turns:
+            return f"{text} Great work, this lesson is complete."
+        return text
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            self.server.requests["deepgram_live"] += 1
+            return self.deepgram_live()
+        if self.path.startswith("/v1/messages/batches/"):
+            return self.message_batch(self.path.split("/")[4], results=self.path.endswith("/results"))
+        self.send_error(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        config = self.server.config
+        roll = random.random()
+        if roll < config.failure_rate:
+            self.server.requests["failed"] += 1
+            self.send_response(503)
+            error = json.dumps({"type": "error", "error": {"type": "api_error", "message": "stand-in failure"},
+                                "err_msg": "stand-in failure"}).encode()
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(error)))
+            self.end_headers()
+            self.wfile.write(error)
+            return
+        if roll < config.failure_rate + config.slow_rate:
+            self.server.requests["slow"] += 1
+            time.sleep(config.slow_latency)
+        if self.path.startswith("/v1/messages/batches"):
+            self.server.requests["anthropic_batches"] += 1
+            self.create_message_batch(json.loads(body))
+        elif self.path.startswith("/v1/messages"):
+            self.server.requests["anthropic"] += 1
+            self.anthropic(json.loads(body))
+        elif self.path.startswith("/v1/listen"):
+            self.server.requests["deepgram"] += 1
+            time.sleep(self.server.config.stt_latency)
+            self.send_json({
+                "metadata": {"transaction_key": "deprecated", "request_id": "benchmark", "sha256": "", "created": "2024-01-01T00:00:00.000Z",
+                             "duration": 1.0, "channels": 1, "models": [], "model_info": {}},
+                "results": {"channels": [{"alternatives": [{"transcript": f"Hola, esta es mi respuesta ({len(body)} bytes).",
+                                                            "confidence": 0.9, "words": []}]}]},
+            })
+        elif "batchexecute" in self.path:
+            self.server.requests["gtts"] += 1
+            time.sleep(self.server.config.tts_latency)
+            payload = ')]}\'\n\n' + json.dumps([["wrb.fr", "jQ1olc", json.dumps([self.server.tts_audio]), None, None, None, "generic"]], separators=(",", ":")) + "\n"
+            self.send_body(payload.encode(), "application/json")
+        else:
+            self.send_error(404)
+
+    def send_body(self, data, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, value):
+        self.send_body(json.dumps(value).encode(), "application/json")
+
+    def anthropic(self, body):
+        config = self.server.config
+        text = self.server.tutor_reply(body)
+        usage = {"input_tokens": len(json.dumps(body)) // 4, "output_tokens": len(text) // 4,
+                 "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        message = {"id": "msg_benchmark", "type": "message", "role": "assistant", "model": body["model"],
+                   "stop_reason": "end_turn", "stop_sequence": None, "usage": usage}
+        time.sleep(config.llm_latency)
+        if not body.get("stream"):
+            time.sleep(len(text.split()) / config.llm_words_per_second)
+            return self.send_json({**message, "content": [{"type": "text", "text": text}]})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.send_event("message_start", {"type": "message_start", "message": {**message, "content": [], "stop_reason": None}})
+        self.send_event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for word in text.split(" "):
+            time.sleep(1 / config.llm_words_per_second)
+            self.send_event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": word + " "}})
+        self.send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self.send_event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                          "usage": {"output_tokens": usage["output_tokens"]}})
+        self.send_event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def create_message_batch(self, body):
+        """Answer every request of a Message Batch up front; the batch reports them once --batch_latency has passed."""
+        config = self.server.config
+        results, errored = [], 0
+        for request in body["requests"]:
+            self.server.requests["anthropic_batch_requests"] += 1
+            if random.random() < config.failure_rate:
+                errored += 1
+                result = {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "stand-in failure"}}}
+            else:
+                params = request["params"]
+                text = self.server.tutor_reply(params)
+                usage = {"input_tokens": len(json.dumps(params)) // 4, "output_tokens": len(text) // 4}
+                result = {"type": "succeeded", "message": {"id": "msg_benchmark", "type": "message", "role": "assistant",
+                                                           "model": params["model"], "content": [{"type": "text", "text": text}],
+                                                           "stop_reason": "end_turn", "stop_sequence": None, "usage": usage}}
+            results.append(json.dumps({"custom_id": request["custom_id"], "result": result}))
+        batch_id = f"msgbatch_benchmark{len(self.server.batches)}"
+        self.server.batches[batch_id] = {"ends_at": time.time() + config.batch_latency, "results": "\n".join(results) + "\n",
+                                         "succeeded": len(results) - errored, "errored": errored}
+        self.message_batch(batch_id)
+
+    def message_batch(self, batch_id, results=False):
+        if batch_id not in self.server.batches:
+            return self.send_error(404)
+        batch = self.server.batches[batch_id]
+        ended = time.time() >= batch["ends_at"]
+        if results:
+            return self.send_body(batch["results"].encode(), "application/binary") if ended else self.send_error(404)
+        counts = {"processing": batch["succeeded"] + batch["errored"], "succeeded": 0, "errored": 0}
+        if ended:
+            counts = {"processing": 0, "succeeded": batch["succeeded"], "errored": batch["errored"]}
+        self.send_json({"id": batch_id, "type": "message_batch", "processing_status": "ended" if ended else "in_progress",
+                        "request_counts": {**counts, "canceled": 0, "expired": 0},
+                        "results_url": f"{self.server.url}/v1/messages/batches/{batch_id}/results" if ended else None})
+
+    def send_event(self, event, data):
+        chunk = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+        self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.flush()
+
+    def deepgram_live(self):
+        """Minimal websocket endpoint: counts audio bytes and answers Finalize with one final result."""
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.close_connection = True
+
+        received = 0
+        while True:
+            opcode, payload = self.read_frame()
+            if opcode is None or opcode == 0x8:
+                break
+            if opcode == 0x9:
+                self.send_frame(0xA, payload)
+            elif opcode == 0x2:
+                received += len(payload)
+            elif opcode == 0x1:
+                message_type = json.loads(payload).get("type")
+                if message_type == "Finalize":
+                    time.sleep(self.server.config.stt_latency)
+                    self.send_frame(0x1, json.dumps({
+                        "type": "Results", "channel_index": [0, 1], "duration": 1.0, "start": 0.0,
+                        "is_final": True, "speech_final": True, "from_finalize": True,
+                        "channel": {"alternatives": [{"transcript": f"Hola, esta es mi respuesta ({received} bytes).",
+                                                      "confidence": 0.9, "words": []}]},
+                        "metadata": {"request_id": "benchmark", "model_info": {"name": "stub", "version": "1", "arch": "stub"},
+                                     "model_uuid": "stub"},
+                    }).encode())
+                elif message_type == "CloseStream":
+                    break
+        self.send_frame(0x8, b"\x03\xe8")
+
+    def read_frame(self):
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None, b""
+        opcode, length = header[0] & 0x0F, header[1] & 0x7F
+        if length == 126:
+            length = int.from_bytes(self.rfile.read(2), "big")
+        elif length == 127:
+            length = int.from_bytes(self.rfile.read(8), "big")
+        mask = self.rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+        payload = self.rfile.read(length)
+        unmasked = int.from_bytes(payload, "big") ^ int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+        return opcode, unmasked.to_bytes(length, "big")
+
+    def send_frame(self, opcode, payload):
+        if len(payload) < 126:
+            header = bytes([0x80 | opcode, len(payload)])
+        elif len(payload) < 1 << 16:
+            header = bytes([0x80 | opcode, 126]) + len(payload).to_bytes(2, "big")
+        else:
+            header = bytes([0x80 | opcode, 127]) + len(payload).to_bytes(8, "big")
+        try:
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+        except OSError:
+            pass
+
+def synthetic_speech(sample_rate=48000, seconds=1.5, lead=0.3, seed=0):
+    """A vowel-like harmonic tone with syllable-rate amplitude modulation, after a short stretch of room noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    voice = sum(np.sin(2 * np.pi * 140 * harmonic * t) / harmonic for harmonic in range(1, 6))
+    voice *= 0.15 * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+    samples = np.concatenate([np.zeros(int(lead * sample_rate)), voice])
+    return (samples + 0.002 * rng.standard_normal(len(samples))).astype(np.float32), sample_rate
+
+class WavInput:
+    """Stand-in for the sounddevice module that plays a WAV signal into the input callback in real time.
+
+    After the signal, quiet room noise keeps flowing until the recording is stopped.
+    """
+
+    def __init__(self, samples, sample_rate, speed=1.0, block_frames=480):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.speed = speed
+        self.block_frames = block_frames
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+    def query_devices(self, device=None, kind=None):
+        return {"name": "benchmark input", "default_samplerate": self.sample_rate}
+
+    def InputStream(self, samplerate, channels, callback):
+        return WavInputStream(self, callback)
+
+class WavInputStream:
+    def __init__(self, device, callback):
+        self.device = device
+        self.callback = callback
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.feed, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed.set()
+        self.thread.join()
+
+    def feed(self):
+        device = self.device
+        rng = np.random.default_rng(1)
+        started = time.perf_counter()
+        position = 0
+        while not self.closed.is_set():
+            block = device.samples[position:position + device.block_frames]
+            if len(block) < device.block_frames:
+                block = np.concatenate([block, 0.002 * rng.standard_normal(device.block_frames - len(block))]).astype(np.float32)
+            position += device.block_frames
+            self.callback(block[:, None], device.block_frames, None, None)
+            if device.speed:
+                time.sleep(max(0.0, started + position / device.sample_rate / device.speed - time.perf_counter()))
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+class LatencyRecorder:
+    """Wraps Talko's stage functions and records how long each takes, per session and turn number."""
+
+    def __init__(self, talko, manual_stop_after=None, barge_in=False):
+        self.talko = talko
+        self.manual_stop_after = manual_stop_after
+        self.barge_in = barge_in
+        self.samples = []
+        self.session = None
+        self.turn = 0
+        self.capture_ended = None
+        self.response_started = None
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.append({"session": self.session, "turn": self.turn, "stage": stage, "seconds": seconds})
+
+    def start_session(self, session):
+        self.session = session
+        self.turn = 0
+        self.response_started = time.perf_counter()
+
+    def timed(self, stage, function):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+        return wrapper
+
+    def install(self):
+        """Patch the stage functions on the talko module."""
+        talko = self.talko
+        capture_blocks, listen, stream_claude = talko.capture_blocks, talko.listen, talko.stream_claude
+        synthesize_parts, play, engine_listen = talko.synthesize_google_parts, talko.audio_output.play, talko.SessionEngine.listen
+
+        def timed_capture(sample_rate, handle_block, stop=None, *args, **kwargs):
+            if self.manual_stop_after is not None and stop is not None:
+                # Press "Ctrl+C" once the answer has been spoken
+                threading.Timer(self.manual_stop_after, stop.set).start()
+            started = time.perf_counter()
+            try:
+                return capture_blocks(sample_rate, handle_block, stop, *args, **kwargs)
+            finally:
+                self.capture_ended = time.perf_counter()
+                self.response_started = self.capture_ended
+                self.record("capture", self.capture_ended - started)
+
+        def timed_listen(*args, **kwargs):
+            self.turn += 1
+            try:
+                return listen(*args, **kwargs)
+            finally:
+                self.record("stt", time.perf_counter() - self.capture_ended)
+
+        def timed_stream_claude(*args, **kwargs):
+            started = time.perf_counter()
+            first = True
+            try:
+                for text in stream_claude(*args, **kwargs):
+                    if first:
+                        self.record("llm_first_text", time.perf_counter() - started)
+                        first = False
+                    yield text
+            finally:
+                self.record("llm", time.perf_counter() - started)
+
+        def playback_started():
+            with self.lock:
+                started, self.response_started = self.response_started, None
+            if started is not None:
+                self.record("response", time.perf_counter() - started)
+
+        def timed_synthesize_parts(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                yield from synthesize_parts(*args, **kwargs)
+            finally:
+                self.record("tts", time.perf_counter() - started)
+
+        def timed_play(segments):
+            def first_segment_heard():
+                for i, segment in enumerate(segments):
+                    if i == 0:
+                        playback_started()
+                    yield segment
+
+            started = time.perf_counter()
+            try:
+                return play(first_segment_heard())
+            finally:
+                self.record("playback", time.perf_counter() - started)
+
+        async def engine_listen_after_reply(engine, prompt):
+            if not self.barge_in:
+                await engine.finish_playback()  # The learner hears the whole reply before answering
+            return await engine_listen(engine, prompt)
+
+        talko.capture_blocks = timed_capture
+        talko.listen = timed_listen
+        talko.stream_claude = timed_stream_claude
+        talko.service_clients.anthropic.messages.create = self.timed("llm", talko.service_clients.anthropic.messages.create)
+        talko.synthesize_google_parts = timed_synthesize_parts
+        talko.audio_output.play = timed_play
+        talko.SessionEngine.listen = engine_listen_after_reply
+
+    def summary(self):
+        """p50/p95 (ms) per session and stage, and per session, turn and stage."""
+        stages = defaultdict(lambda: defaultdict(list))
+        turns = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        for sample in self.samples:
+            stages[sample["session"]][sample["stage"]].append(sample["seconds"] * 1000)
+            turns[sample["session"]][sample["turn"]][sample["stage"]].append(sample["seconds"] * 1000)
+
+        def stats(values):
+            return {"n": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95)}
+
+        return {
+            "stages": {session: {stage: stats(values) for stage, values in by_stage.items()} for session, by_stage in stages.items()},
+            "turns": {session: {str(turn): {stage: stats(values) for stage, values in by_stage.items()} for turn, by_stage in sorted(by_turn.items())}
+                      for session, by_turn in turns.items()},
+        }
+
+def print_report(summary):
+    for session, by_stage in summary["stages"].items():
+        print(f"\n{session}: latency per stage (ms)")
+        print(f"  {'stage':<16}{'n':>6}{'p50':>10}{'p95':>10}")
+        for stage in STAGES:
+            if stage in by_stage:
+                stats = by_stage[stage]
+                print(f"  {stage:<16}{stats['n']:>6}{stats['p50']:>10.1f}{stats['p95']:>10.1f}")
+
+        print(f"\n{session}: p50 latency per turn (ms; turn 0 is the opening reply)")
+        shown = [stage for stage in STAGES if stage in by_stage]
+        print("  " + f"{'turn':<6}" + "".join(f"{stage:>16}" for stage in shown))
+        for turn, by_turn_stage in summary["turns"][session].items():
+            cells = "".join(f"{by_turn_stage[stage]['p50']:>16.1f}" if stage in by_turn_stage else f"{'-':>16}" for stage in shown)
+            print(f"  {turn:<6}" + cells)
+
+def find_regressions(summary, baseline, tolerance, slack_ms):
+    """Stages whose p95 grew by more than `tolerance` (a fraction) plus `slack_ms` over the baseline."""
+    regressions = []
+    for session, by_stage in baseline["stages"].items():
+        for stage, stats in by_stage.items():
+            current = summary["stages"].get(session, {}).get(stage)
+            if current and stats["p95"] is not None and current["p95"] > stats["p95"] * (1 + tolerance) + slack_ms:
+                regressions.append((session, stage, stats["p95"], current["p95"]))
+    return regressions
+
+def check_tts_cache_playback(talko, lang, words=150):
+    """Speak a multi-chunk reply twice, so the second comes from the TTS cache, and return both played durations."""
+    text = filler_text(words, seed=words)
+    durations = []
+    for _ in range(2):
+        player = talko.NullPlayer(realtime=False)
+        player.play(talko.synthesize_google_parts(text, lang))
+        durations.append(player.seconds_played)
+    return durations
+
+def import_talko(server, workdir, device=None):
+    """Import talko with every service pointed at the stand-in server and speech discarded."""
+    # The service clients read their endpoints when talko is imported
+    os.environ.update(ANTHROPIC_BASE_URL=server.url, ANTHROPIC_API_KEY="benchmark", DEEPGRAM_URL=server.url,
+                      DEEPGRAM_API_KEY="benchmark", GTTS_URL=server.url, TALKO_CACHE_DIR=os.path.join(workdir, "cache"))
+    import talko
+    if device is not None:
+        # talko only reaches sounddevice through talko.sd, so with a stand-in PortAudio is never loaded
+        talko.sd = device
+    elif importlib.util.find_spec("sounddevice") is None:
+        sys.exit("Recording from the microphone needs the sounddevice package")
+    else:
+        try:
+            talko.sd.query_devices(None, "input")
+        except OSError as e:  # Installed, but the PortAudio library is missing
+            sys.exit(f"Can't open the microphone: {e}")
+    talko.audio_output = talko.NullPlayer(realtime=True)
+    return talko
+
+class BenchmarkArgs(Tap):
+    runs: int = 3  # Sessions of each kind to run
+    sessions: List[Literal["diagnostic", "lesson"]] = ["diagnostic", "lesson"]  # Which session kinds to run
+    lang: str = "es"  # Language code of the sessions
+    level: int = 3  # Level for lessons
+    stream: bool = False  # Stream replies and speak them sentence by sentence
+    stt: Literal["prerecorded", "live"] = "prerecorded"  # Transcribe after recording, or live while speaking
+    capture: Literal["memory", "file"] = "memory"  # Keep recordings in memory or write recording.wav
+    audio_format: Literal["flac", "opus"] = "flac"  # Upload format for in-memory recordings
+    manual_stop: bool = False  # Stop each recording like Ctrl+C right after the answer instead of with --auto_stop endpointing
+    silence_hangover: float = 0.6  # Seconds of silence that end a recording with endpointing
+    input_wav: str = ""  # WAV file to use as every learner answer (default: synthetic speech)
+    input_speed: float = 1.0  # Input playback speed; 1 is real time, 0 as fast as possible
+    barge_in: bool = False  # Start answering as soon as a reply starts playing instead of after it ends
+    tts_cache: bool = False  # Keep the TTS disk cache enabled (in a temporary directory)
+    llm_cache: List[Literal["diagnostic", "topic"]] = []  # Talko call sites whose replies may come from the response cache (in a temporary directory)
+    llm_latency: float = 0.5  # Seconds before Claude's first byte
+    llm_words: int = 60  # Words per tutor reply
+    llm_words_per_second: float = 40.0  # Streaming speed of replies
+    stt_latency: float = 0.3  # Seconds Deepgram takes to return a transcript
+    tts_latency: float = 0.25  # Seconds Google TTS takes per request
+    segment_seconds: float = 0.5  # Seconds of audio in each synthesized mp3 segment
+    diagnostic_questions: int = 3  # Learner answers before the evaluator assigns a level
+    lesson_turns: int = 4  # Learner answers before the tutor ends the lesson
+    failure_rate: float = 0.0  # Fraction of service requests that fail with a 503
+    slow_rate: float = 0.0  # Fraction of service requests delayed by --slow_latency (tail latency)
+    slow_latency: float = 5.0  # Extra seconds a slow request takes
+    batch_latency: float = 2.0  # Seconds before a Message Batch ends
+    stand_ins: bool = False  # Only run the stand-in services until Ctrl+C, e.g. to try talko.py --recompute_progress offline
+    policy: List[str] = []  # Talko stage policy overrides, e.g. tts.hedge_after=0.5 llm.retries=0
+    output: str = ""  # Write the results as JSON to this file
+    baseline: str = ""  # Compare against results JSON from an earlier run; exit 1 on a regression
+    tolerance: float = 0.2  # Allowed p95 growth over the baseline, as a fraction
+    slack_ms: float = 20.0  # Allowed p95 growth over the baseline in ms, on top of the tolerance
+    verbose: bool = False  # Show Talko's own output
+
+def main(args):
+    config = StubConfig(**{field: getattr(args, field) for field in StubConfig.__dataclass_fields__})
+    server = StubServer(config).start()
+    if args.stand_ins:
+        print("Stand-ins running; point talko.py at them with:")
+        print(f"  export ANTHROPIC_BASE_URL={server.url} ANTHROPIC_API_KEY=benchmark DEEPGRAM_URL={server.url} "
+              f"DEEPGRAM_API_KEY=benchmark GTTS_URL={server.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            print(f"\nStand-in requests: {dict(server.requests)}")
+        return
+    workdir = tempfile.mkdtemp(prefix="talko-benchmark-")
+    if args.input_wav:
+        samples, sample_rate = sf.read(args.input_wav, dtype="float32", always_2d=True)
+        samples = samples.mean(axis=1)
+    else:
+        samples, sample_rate = synthetic_speech()
+    device = WavInput(samples, sample_rate, args.input_speed)
+    talko = import_talko(server, workdir, device)
+    talko.tts_cache = talko.AudioCache(os.path.join(workdir, "cache", "tts"), 200 * 1024 * 1024 if args.tts_cache else 0)
+    talko.llm_cache = talko.ResponseCache(os.path.join(workdir, "cache", "llm.sqlite3"), args.llm_cache)
+    talko.configure_stage_policies(args.policy)
+
+    async def press_enter(prompt):
+        return ""
+    talko.ainput = press_enter
+
+    manual_stop_after = device.duration / (args.input_speed or float("inf")) + 0.1 if args.manual_stop else None
+    recorder = LatencyRecorder(talko, manual_stop_after, args.barge_in)
+    recorder.install()
+
+    options = talko.SessionOptions(stream=args.stream, capture=args.capture, audio_format=args.audio_format, stt=args.stt,
+                                   auto_stop=not args.manual_stop, silence_hangover=args.silence_hangover)
+    os.chdir(workdir)  # File capture writes recording.wav to the working directory
+    output = sys.stdout if args.verbose else io.StringIO()
+    started = time.perf_counter()
+    for run in range(args.runs):
+        for session in args.sessions:
+            user_folder = os.path.join(workdir, f"user-{run}-{session}")
+            os.makedirs(user_folder)
+            recorder.start_session(session)
+            with contextlib.redirect_stdout(output):
+                if session == "diagnostic":
+                    talko.diagnostic_test(args.lang, user_folder, options)
+                else:
+                    talko.generate_lesson(args.lang, args.level, user_folder, options)
+            print(f"run {run + 1}/{args.runs}: {session} done")
+
+    summary = recorder.summary()
+    summary["config"] = {**asdict(config), "stream": args.stream, "stt": args.stt, "capture": args.capture,
+                         "audio_format": args.audio_format, "manual_stop": args.manual_stop, "runs": args.runs}
+    summary["requests"] = dict(server.requests)
+    summary["stage_calls"] = {stage: calls.stats() for stage, calls in talko.stage_calls.items()}
+    summary["llm_cache"] = talko.llm_cache.stats()
+    print_report(summary)
+    print(f"\nStand-in requests: {dict(server.requests)}; total time {time.perf_counter() - started:.1f}s")
+    print(f"Stage calls: {summary['stage_calls']}")
+    cache_check_failed = False
+    if args.tts_cache:
+        miss_seconds, hit_seconds = check_tts_cache_playback(talko, args.lang)
+        summary["tts_cache_playback"] = {"miss_s": miss_seconds, "hit_s": hit_seconds}
+        print(f"TTS cache playback: {miss_seconds:.1f}s synthesized, {hit_seconds:.1f}s from the cache")
+        if abs(hit_seconds - miss_seconds) > 0.1:
+            print(f"TTS CACHE: a cache hit played {hit_seconds:.1f}s of a {miss_seconds:.1f}s reply")
+            cache_check_failed = True
+    if args.llm_cache:
+        print(f"Response cache: {summary['llm_cache']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(summary, baseline, args.tolerance, args.slack_ms)
+        for session, stage, before, after in regressions:
+            print(f"REGRESSION {session}/{stage}: p95 {before:.1f} ms -> {after:.1f} ms")
+        if regressions:
+            sys.exit(1)
+        print("No latency regressions against the baseline.")
+
+    if cache_check_failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(BenchmarkArgs().parse_args())
@@ -0,0 +1,111 @@
+"""Startup-time benchmark for Talko.
+
+Times `import talko`, `python talko.py --help` and an invalid-level run in fresh interpreters,
+none of which should load the service SDKs or audio libraries, and lists the slowest imports
+from `python -X importtime`. Can compare against a saved baseline to catch startup regressions.
+
+    python import_benchmark.py --runs 10 --output startup.json
+    python import_benchmark.py --runs 10 --baseline startup.json  # exits 1 on a regression
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from tap import Tap
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Command lines timed in a fresh interpreter each run
+SCENARIOS = {
+    "import": ["-c", "import talko"],
+    "help": ["talko.py", "--help"],
+    "invalid_level": ["talko.py", "--user", "startup-benchmark", "--level", "11"],
+}
+
+# Modules that `import talko` should leave for later
+DEFERRED_MODULES = ("anthropic", "deepgram", "gtts", "httpx", "numpy", "requests", "sounddevice", "soundfile", "tap", "websockets")
+
+class ImportBenchmarkArgs(Tap):
+    runs: int = 10  # Fresh interpreters per scenario
+    top: int = 10  # Slowest imports to list
+    output: str = ""  # Write the results as JSON to this file
+    baseline: str = ""  # Compare against results JSON from an earlier run; exit 1 on a regression
+    tolerance: float = 0.2  # Allowed median growth over the baseline, as a fraction
+    slack_ms: float = 20.0  # Allowed median growth over the baseline in ms, on top of the tolerance
+
+def time_command(args):
+    """Run Python with `args` in the repo directory and return the wall time in ms."""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return (time.perf_counter() - started) * 1000
+
+def import_profile():
+    """Cumulative import time per module (ms) for `import talko`, from -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import talko"], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=False)
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            profile[module.strip()] = int(cumulative) / 1000
+    return profile
+
+def loaded_modules():
+    """Top-level modules from DEFERRED_MODULES that `import talko` loads anyway."""
+    check = f"import sys, talko; print(' '.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", check], cwd=REPO_DIR, capture_output=True, text=True, check=False)
+    return result.stdout.split()
+
+def find_regressions(summary, baseline, tolerance, slack_ms):
+    """Scenarios whose median grew by more than `tolerance` (a fraction) plus `slack_ms` over the baseline."""
+    regressions = []
+    for scenario, stats in baseline["scenarios"].items():
+        current = summary["scenarios"].get(scenario)
+        if current and current["p50"] > stats["p50"] * (1 + tolerance) + slack_ms:
+            regressions.append((scenario, stats["p50"], current["p50"]))
+    return regressions
+
+def main(args):
+    time_command(["-c", "import talko"])  # Warm the filesystem cache and bytecode
+    summary = {"python": sys.version.split()[0], "scenarios": {}}
+    print(f"{'startup (ms)':<16}{'p50':>10}{'min':>10}{'max':>10}")
+    for scenario, command in SCENARIOS.items():
+        times = [time_command(command) for _ in range(args.runs)]
+        stats = {"p50": statistics.median(times), "min": min(times), "max": max(times)}
+        summary["scenarios"][scenario] = stats
+        print(f"{scenario:<16}{stats['p50']:>10.1f}{stats['min']:>10.1f}{stats['max']:>10.1f}")
+
+    baseline_ms = time_command(["-c", "pass"])
+    print(f"(an empty interpreter takes {baseline_ms:.1f} ms)")
+
+    profile = import_profile()
+    summary["imports"] = dict(sorted(profile.items(), key=lambda item: -item[1])[:args.top])
+    print("\nSlowest imports under `import talko` (cumulative ms):")
+    for module, ms in summary["imports"].items():
+        print(f"  {module:<40}{ms:>8.1f}")
+
+    summary["eagerly_loaded"] = loaded_modules()
+    if summary["eagerly_loaded"]:
+        print(f"\nLoaded by `import talko` but meant to be deferred: {', '.join(summary['eagerly_loaded'])}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(summary, baseline, args.tolerance, args.slack_ms)
+        for scenario, before, after in regressions:
+            print(f"REGRESSION {scenario}: p50 {before:.1f} ms -> {after:.1f} ms")
+        if regressions or summary["eagerly_loaded"]:
+            sys.exit(1)
+        print("No startup regressions against the baseline.")
+
+if __name__ == "__main__":
+    main(ImportBenchmarkArgs().parse_args())
@@ -0,0 +1,203 @@
+"""Load test for Talko's session server (python talko.py --serve).
+
+Simulates many learners taking diagnostic tests or lessons at once. Each learner connects over
+a websocket, waits for each reply to finish playing (or barges in), thinks, and uploads a
+synthetic spoken answer. By default the server runs in this process against the benchmark's
+local stand-ins for Anthropic, Deepgram and Google TTS, so no API keys are needed.
+
+    python loadtest.py --learners 200 --ramp_up 10
+    python loadtest.py --url ws://localhost:8765 --learners 20  # against a running server
+"""
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict
+from typing import Literal
+
+import soundfile as sf
+import websockets
+from tap import Tap
+
+from benchmark import StubConfig, StubServer, WavInput, import_talko, percentile, synthetic_speech
+
+class LoadTestArgs(Tap):
+    learners: int = 100  # Simulated learners
+    ramp_up: float = 5.0  # Seconds over which the learners connect
+    session: Literal["diagnostic", "lesson"] = "lesson"  # Session each learner runs
+    lang: str = "es"  # Language code of the sessions
+    level: int = 3  # Level for lessons
+    think_time: float = 0.5  # Mean seconds a learner waits before answering (exponentially distributed)
+    barge_in: bool = False  # Answer as soon as the reply starts instead of after it has played
+    url: str = ""  # Session server to test (default: start one in this process against the stand-ins)
+    max_sessions: int = 1000  # Concurrent sessions allowed by the in-process server
+    stream: bool = False  # Have the in-process server stream replies sentence by sentence
+    input_wav: str = ""  # WAV file to upload as every answer (default: synthetic speech)
+    llm_latency: float = 0.5  # Seconds before Claude's first byte
+    llm_words: int = 60  # Words per tutor reply
+    llm_words_per_second: float = 40.0  # Streaming speed of replies
+    stt_latency: float = 0.3  # Seconds Deepgram takes to return a transcript
+    tts_latency: float = 0.25  # Seconds Google TTS takes per request
+    segment_seconds: float = 0.5  # Seconds of audio in each synthesized mp3 segment
+    diagnostic_questions: int = 3  # Learner answers before the evaluator assigns a level
+    lesson_turns: int = 4  # Learner answers before the tutor ends the lesson
+    failure_rate: float = 0.0  # Fraction of service requests that fail with a 503
+    slow_rate: float = 0.0  # Fraction of service requests delayed by --slow_latency (tail latency)
+    slow_latency: float = 5.0  # Extra seconds a slow request takes
+    output: str = ""  # Write the results as JSON to this file
+
+class LoadStats:
+    """Latencies and outcomes collected from every simulated learner."""
+
+    def __init__(self):
+        self.first_reply = []  # Seconds from connecting to the first audio of the opening reply
+        self.response = []  # Seconds from uploading an answer to the first audio of the reply
+        self.sessions = []  # Seconds per completed session
+        self.outcomes = defaultdict(int)
+        self.audio_bytes = 0
+
+    def summary(self, elapsed):
+        summary = {"outcomes": dict(self.outcomes), "elapsed_s": elapsed, "answers": len(self.response),
+                   "answers_per_s": len(self.response) / elapsed if elapsed else 0.0,
+                   "audio_mb": self.audio_bytes / 1e6}
+        for name in ("first_reply", "response", "sessions"):
+            values = [seconds * 1000 for seconds in getattr(self, name)]
+            summary[name] = {"n": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                             "p99": percentile(values, 99), "max": max(values, default=0.0)}
+        return summary
+
+def print_report(summary):
+    print(f"\n{'latency (ms)':<14}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name in ("first_reply", "response", "sessions"):
+        row = summary[name]
+        print(f"{name:<14}{row['n']:>7}{row['p50']:>10.1f}{row['p95']:>10.1f}{row['p99']:>10.1f}{row['max']:>10.1f}")
+    print(f"\nOutcomes: {summary['outcomes']}")
+    print(f"{summary['answers']} answers in {summary['elapsed_s']:.1f}s ({summary['answers_per_s']:.1f}/s), "
+          f"{summary['audio_mb']:.1f} MB of reply audio")
+
+async def learner(index, url, args, answer, stats):
+    """Run one learner's session from start to finish."""
+    rng = random.Random(index)
+    started = time.perf_counter()
+    replies = 0  # Replies the server has started
+    replies_played = 0  # Replies whose audio has been received in full
+    answered_at = None  # When the last answer was uploaded
+    waiting_for_audio = True
+    must_answer = False
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=60) as websocket:
+            level = "diagnostic" if args.session == "diagnostic" else str(args.level)
+            await websocket.send(json.dumps({"type": "start", "user": f"learner{index}", "lang": args.lang, "level": level}))
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    stats.audio_bytes += len(message)
+                    if waiting_for_audio:
+                        if answered_at is None:
+                            stats.first_reply.append(time.perf_counter() - started)
+                        else:
+                            stats.response.append(time.perf_counter() - answered_at)
+                        waiting_for_audio = False
+                    continue
+                message = json.loads(message)
+                if message["type"] == "audio_start":
+                    replies += 1
+                elif message["type"] == "audio_end":
+                    replies_played += 1
+                elif message["type"] == "listen":
+                    must_answer = True
+                elif message["type"] == "done":
+                    stats.sessions.append(time.perf_counter() - started)
+                    stats.outcomes["completed"] += 1
+                    return
+                elif message["type"] == "error":
+                    stats.outcomes["busy" if "busy" in message["message"] else "error"] += 1
+                    return
+
+                if must_answer and (args.barge_in or replies_played == replies):
+                    must_answer = False
+                    await asyncio.sleep(rng.expovariate(1 / args.think_time) if args.think_time else 0)
+                    await websocket.send(answer)
+                    answered_at = time.perf_counter()
+                    waiting_for_audio = True
+        stats.outcomes["disconnected"] += 1
+    except websockets.ConnectionClosed as e:
+        stats.outcomes["busy" if e.rcvd is not None and e.rcvd.code == 1013 else "disconnected"] += 1
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+        stats.outcomes["connection_failed"] += 1
+
+def start_server(args, workdir):
+    """Start the stand-ins and a session server on a background event loop, returning its URL."""
+    config = StubConfig(**{field: getattr(args, field) for field in StubConfig.__dataclass_fields__ if hasattr(args, field)})
+    stubs = StubServer(config).start()
+    samples, sample_rate = synthetic_speech()
+    talko = import_talko(stubs, workdir, WavInput(samples, sample_rate))
+    talko.tts_cache = talko.AudioCache(os.path.join(workdir, "cache", "tts"), 0)
+    talko.resize_service_pools(args.max_sessions)
+    options = talko.SessionOptions(stream=args.stream)
+    sys.stdout = talko.SessionStdout(sys.stdout)  # Session output goes to each learner's log
+
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    port = []
+
+    async def run():
+        server = talko.SessionServer(os.path.join(workdir, "users"), options, args.max_sessions)
+        loop.set_default_executor(talko.concurrent.futures.ThreadPoolExecutor(max_workers=4 * args.max_sessions + 8))
+        async with websockets.serve(server.handle, "127.0.0.1", 0, max_size=8 * 1024 * 1024) as ws_server:
+            port.append(next(iter(ws_server.sockets)).getsockname()[1])
+            ready.set()
+            await asyncio.Future()
+
+    threading.Thread(target=loop.run_until_complete, args=(run(),), daemon=True).start()
+    ready.wait()
+    return f"ws://127.0.0.1:{port[0]}", talko, stubs
+
+async def run_learners(url, args, answer, stats):
+    async def delayed(index):
+        await asyncio.sleep(args.ramp_up * index / max(args.learners, 1))
+        await learner(index, url, args, answer, stats)
+    await asyncio.gather(*(delayed(index) for index in range(args.learners)))
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="talko-loadtest-")
+    stubs = None
+    if args.url:
+        url = args.url
+    else:
+        url, talko, stubs = start_server(args, workdir)
+        print(f"Session server on {url}, stand-ins on {stubs.url}")
+
+    if args.input_wav:
+        with open(args.input_wav, "rb") as f:
+            answer = f.read()
+    else:
+        samples, sample_rate = synthetic_speech(sample_rate=16000)
+        encoded = io.BytesIO()
+        sf.write(encoded, samples, sample_rate, format="FLAC", subtype="PCM_16")
+        answer = encoded.getvalue()
+
+    stats = LoadStats()
+    started = time.perf_counter()
+    asyncio.run(run_learners(url, args, answer, stats))
+    summary = stats.summary(time.perf_counter() - started)
+    summary["config"] = {"learners": args.learners, "ramp_up": args.ramp_up, "session": args.session,
+                         "think_time": args.think_time, "barge_in": args.barge_in, "stream": args.stream}
+    if stubs is not None:
+        summary["config"]["stubs"] = asdict(stubs.config)
+        summary["requests"] = dict(stubs.requests)
+    print_report(summary)
+    if stubs is not None:
+        print(f"Stand-in requests: {dict(stubs.requests)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main(LoadTestArgs().parse_args())
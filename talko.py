@@ -1,31 +1,69 @@
+import asyncio
+import concurrent.futures
 import os
 import queue
 import re
+import signal
 import sys
-import anthropic
+import shutil
 import subprocess
-from gtts import gTTS
-from gtts.lang import tts_langs
 import tempfile
 import random
 import json
+import threading
+import time
+import fcntl
+import functools
+import hashlib
+import importlib
+import io
+import mmap
+import sqlite3
+import stat
+import unicodedata
+import base64
+import contextvars
+import itertools
+from contextlib import ExitStack, closing, suppress
+from collections import defaultdict, deque
+from dataclasses import dataclass, fields, replace
 from datetime import datetime
 
-# Recording speech
-import sounddevice as sd
-import soundfile as sf
-
-# Command line arguments
-from tap import Tap
-
 import colorama
 from colorama import Fore, Style
 
-# Deepgram imports
-from deepgram import (
-    DeepgramClient,
-    PrerecordedOptions,
-)
+class LazyModule:
+    """Stands in for a module and imports it the first time one of its attributes is used.
+
+    Keeps `import talko`, --help and argument errors fast: the service SDKs, NumPy and the
+    audio libraries load once a session needs them (or while main() warms up in the
+    background), and PortAudio isn't probed until something is recorded or played.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+anthropic = LazyModule("anthropic")
+deepgram = LazyModule("deepgram")
+gtts = LazyModule("gtts")
+gtts_lang = LazyModule("gtts.lang")
+httpx = LazyModule("httpx")
+np = LazyModule("numpy")
+requests = LazyModule("requests")
+websockets = LazyModule("websockets")
+
+# Recording speech
+sd = LazyModule("sounddevice")
+sf = LazyModule("soundfile")
+
+# Imported by ServiceClients.warm_up() while the session starts, ahead of their first use
+WARM_UP_IMPORTS = ("deepgram", "gtts", "numpy", "soundfile")
 
 # Initialize colorama
 colorama.init()
@@ -79,101 +117,1609 @@ DEEPGRAM_LANG_CODES = {
     'sv': 'sv',         # Swedish
 }
 
-anthropic_client = anthropic.Anthropic()
+# Sentence boundaries for streamed replies: Latin punctuation followed by whitespace, or CJK full stops
+SENTENCE_BOUNDARY_RE = re.compile(r'[.!?…]+["\'”’»)]*\s+|[。！？]+')
 
-def record_speech():
-    """Record user speech and save as wav file."""
-    q = queue.Queue()
-    filename = None
+# Sample rate Deepgram works at natively; recordings are resampled to this before upload
+STT_SAMPLE_RATE = 16000
+
+# In-memory upload formats as (soundfile format, subtype)
+AUDIO_FORMATS = {
+    "flac": ("FLAC", "PCM_16"),
+    "opus": ("OGG", "OPUS"),
+}
+
+# Deepgram endpoint override, e.g. a local stand-in server for testing (defaults to api.deepgram.com)
+DEEPGRAM_URL = os.environ.get("DEEPGRAM_URL", "")
+
+# Google Translate TTS endpoint override, e.g. a local stand-in server for testing
+GTTS_URL = os.environ.get("GTTS_URL", "https://translate.google.com")
+
+# Model behind the tutor, the evaluator and topic generation
+CLAUDE_MODEL = "claude-3-5-sonnet-latest"
+
+# Anthropic prompt caching (beta): marks stable prompt prefixes so later requests read them from cache
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Per-user progress history database, kept in the user folder
+PROGRESS_DB = "progress.sqlite3"
+
+# Progress files written before the database existed; other JSON in a user folder (e.g. prepared lessons) isn't progress
+PROGRESS_FILE_RE = re.compile(r"^progress_\d{8}_\d{6}\.json$")
+PROGRESS_FIELDS = ("timestamp", "language", "current_level", "lesson_summary", "overall_progress", "language_goals", "proximal_development")
+
+# Prepared next lesson per language (--prefetch), kept in the user folder as JSON plus its audio segments
+NEXT_LESSON_FILE = "next_lesson_{lang}"
+
+# Checkpoint of a --recompute_progress job, kept in the directory of user folders being recomputed
+RECOMPUTE_CHECKPOINT = "progress_recompute.json"
+
+# Requests per Message Batch (the API accepts up to 100,000 requests or 256 MB per batch)
+BATCH_MAX_REQUESTS = 10000
+
+# Recomputed records between checkpoint saves; records written since the last save are
+# recognized on resume because they are no longer the source record, so none are redone
+CHECKPOINT_EVERY = 50
+
+# Command used by the 'command' audio player (CommandPlayer) to play synthesized mp3 files
+AUDIO_PLAYER = "afplay"
+
+# Where cached audio and other reusable artifacts are kept between runs
+DEFAULT_CACHE_DIR = os.environ.get("TALKO_CACHE_DIR", os.path.expanduser("~/.cache/talko"))
+
+# Word lists for lesson inspiration words: <lang>.txt files (one word per line, optionally followed by
+# a frequency count, most frequent first) in WORD_LIST_DIR, falling back to the system dictionary
+DICTIONARY_PATH = "/usr/share/dict/words"
+WORD_LIST_DIR = os.environ.get("TALKO_WORD_LISTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "words"))
+
+@dataclass
+class SessionOptions:
+    """Settings for how a lesson or diagnostic test talks to the learner."""
+    stream: bool = False  # Stream Claude's replies and speak them sentence by sentence
+    capture: str = "memory"  # 'memory' encodes audio in memory, 'file' records to recording.wav
+    audio_format: str = "flac"  # Upload format for in-memory capture: 'flac' or 'opus'
+    stt: str = "prerecorded"  # 'prerecorded' transcribes after recording, 'live' while the learner speaks
+    prompt_cache: bool = True  # Mark stable prompt prefixes for Anthropic prompt caching
+    context_budget: int = 8000  # Summarize older turns once a request exceeds this many input tokens (0 disables)
+    auto_stop: bool = False  # End each recording automatically once the learner pauses
+    silence_hangover: float = 1.0  # Seconds of silence after speech that end a recording when auto_stop is on
+    prefetch: bool = False  # Prepare the next lesson's opening after each session, and start from it when valid
+
+class NullSpan:
+    """The span handed out while tracing is off; every method is a no-op."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+NULL_SPAN = NullSpan()
+current_span = contextvars.ContextVar("current_span", default=NULL_SPAN)
+current_turn = contextvars.ContextVar("current_turn", default=0)
+current_session = contextvars.ContextVar("current_session", default=None)  # Set per learner in server mode
+
+class Span:
+    """A timed operation; attributes set while it runs are written with its trace record."""
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(tracer.span_ids)
+        self.otel = None
+
+    def __enter__(self):
+        self.parent = current_span.get()
+        self.token = current_span.set(self)
+        self.start = time.time()
+        self.started = time.perf_counter()
+        if self.tracer.otel is not None:
+            parent = self.tracer.otel_trace.set_span_in_context(self.parent.otel) if isinstance(self.parent, Span) else None
+            self.otel = self.tracer.otel.start_span(self.name, context=parent, start_time=time.time_ns())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        try:
+            current_span.reset(self.token)
+        except ValueError:
+            pass  # Exited from another context (e.g. a generator finished elsewhere)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.finish(self, duration)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+# Durations kept per span name for the summary's percentiles; beyond this, a uniform random sample is kept
+TRACE_SAMPLE_SIZE = 2000
+
+class Tracer:
+    """Per-session spans (durations, bytes, tokens, retries) written as JSONL, with an end-of-session summary.
+
+    Disabled until opened; while disabled, span() returns NULL_SPAN and costs a single attribute check.
+    Spans can also be exported through the globally configured OpenTelemetry tracer provider.
+    Finished spans are folded into per-name counts and a bounded sample of durations rather than
+    kept, so a long-running server doesn't accumulate them.
+    """
+
+    SUMMED_ATTRIBUTES = ("bytes_uploaded", "bytes_downloaded", "input_tokens", "output_tokens",
+                         "cache_read_input_tokens", "cache_creation_input_tokens", "http_requests", "retries",
+                         "timeouts", "hedges")
+
+    def __init__(self):
+        self.enabled = False
+        self.file = None
+        self.otel = None
+        self.otel_trace = None
+        self.session = None
+        self.reset_summary()
+        self.span_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def open(self, trace_dir=None, session=None, otel=False):
+        """Start tracing a session, writing <trace_dir>/<session>.jsonl if trace_dir is given."""
+        self.session = session or datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.reset_summary()
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+            self.path = os.path.join(trace_dir, f"{self.session}.jsonl")
+            self.file = open(self.path, "a", buffering=1)
+        if otel:
+            try:
+                from opentelemetry import trace as otel_trace
+            except ImportError:
+                print(f"{Fore.RED}OpenTelemetry export needs the opentelemetry-api package; skipping it{Style.RESET_ALL}")
+            else:
+                self.otel_trace = otel_trace
+                self.otel = otel_trace.get_tracer("talko")
+        self.enabled = True
+
+    def reset_summary(self):
+        self.span_stats = {}  # Span name -> {"count", "total_ms", "sample" of durations}
+        self.totals = dict.fromkeys(self.SUMMED_ATTRIBUTES, 0)
+
+    def span(self, name, **attributes):
+        """Return a context manager timing `name`; use .set()/.add() on it to attach attributes."""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def finish(self, span, duration):
+        attributes = span.attributes
+        record = {
+            "session": current_session.get() or self.session,
+            "turn": current_turn.get(),
+            "span": span.name,
+            "span_id": span.span_id,
+            "parent_id": span.parent.span_id if isinstance(span.parent, Span) else None,
+            "start": round(span.start, 6),
+            "duration_ms": round(duration * 1000, 3),
+            **attributes,
+        }
+        with self.lock:
+            stats = self.span_stats.setdefault(span.name, {"count": 0, "total_ms": 0.0, "sample": []})
+            stats["count"] += 1
+            stats["total_ms"] += record["duration_ms"]
+            if len(stats["sample"]) < TRACE_SAMPLE_SIZE:
+                stats["sample"].append(record["duration_ms"])
+            else:
+                # Reservoir sampling: every duration so far is equally likely to be in the sample
+                slot = random.randrange(stats["count"])
+                if slot < TRACE_SAMPLE_SIZE:
+                    stats["sample"][slot] = record["duration_ms"]
+            for key in self.SUMMED_ATTRIBUTES:
+                self.totals[key] += attributes.get(key, 0)
+            if self.file is not None:
+                self.file.write(json.dumps(record, default=str) + "\n")
+        if span.otel is not None:
+            span.otel.set_attributes({key: value for key, value in attributes.items() if isinstance(value, (str, bool, int, float))})
+            span.otel.end()
+
+    def summary(self):
+        """Latency percentiles per span name, plus totals of bytes, tokens and retries."""
+        with self.lock:
+            span_stats = {name: {**stats, "sample": list(stats["sample"])} for name, stats in self.span_stats.items()}
+            totals = dict(self.totals)
+        spans = {
+            name: {"count": stats["count"], "p50_ms": float(np.percentile(stats["sample"], 50)),
+                   "p95_ms": float(np.percentile(stats["sample"], 95)), "total_ms": stats["total_ms"]}
+            for name, stats in span_stats.items()
+        }
+        return {"spans": spans, "totals": totals}
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{Fore.CYAN}Latency summary:{Style.RESET_ALL}")
+        for name, stats in sorted(summary["spans"].items()):
+            print(f"  {name:<16} {stats['count']:>4}x  p50 {stats['p50_ms']:>8.1f} ms  p95 {stats['p95_ms']:>8.1f} ms  total {stats['total_ms'] / 1000:>6.1f} s")
+        totals = summary["totals"]
+        print(f"  tokens: {totals['input_tokens']} in ({totals['cache_read_input_tokens']} cached), {totals['output_tokens']} out; "
+              f"bytes: {totals['bytes_uploaded']} up, {totals['bytes_downloaded']} down; "
+              f"retries: {totals['retries']}, timeouts: {totals['timeouts']}, hedges: {totals['hedges']}")
+
+    def close(self):
+        """Write the session summary record and stop tracing."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.file is not None:
+            self.file.write(json.dumps({"session": self.session, "summary": self.summary()}) + "\n")
+            self.file.close()
+            self.file = None
+
+tracer = Tracer()
+
+def record_usage(span, usage):
+    """Attach the token counts of an Anthropic `usage` object to a span."""
+    span.set(
+        input_tokens=usage.input_tokens,
+        output_tokens=usage.output_tokens,
+        cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", None) or 0,
+        cache_creation_input_tokens=getattr(usage, "cache_creation_input_tokens", None) or 0,
+    )
+
+# Idle pooled connections are kept this long; learners often take a while to answer
+KEEPALIVE_SECONDS = 120
+
+# Keep-alive connections kept per service; server mode raises this to its session limit
+POOL_SIZE = 10
+
+class PooledTransport:
+    """Keep-alive httpx transport that outlives the clients using it.
+
+    The Deepgram SDK opens and closes a new httpx.Client for every request. Handing it this
+    transport keeps the underlying connections (and their TLS sessions) alive between turns.
+    It wraps an httpx.HTTPTransport rather than subclassing it, so httpx loads on first use.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, **kwargs):
+        kwargs.setdefault("limits", httpx.Limits(max_keepalive_connections=pool_size, keepalive_expiry=KEEPALIVE_SECONDS))
+        self.transport = httpx.HTTPTransport(**kwargs)
+        self.requests = 0
+        self.connections_opened = 0
+        self.last_used = float("-inf")  # time.monotonic() of the latest request
+
+    def handle_request(self, request):
+        self.requests += 1
+        self.last_used = time.monotonic()
+        request.extensions["trace"] = functools.partial(self.trace, request.extensions.get("trace"))
+        span = current_span.get()
+        span.add("http_requests")
+        span.add("bytes_uploaded", int(request.headers.get("content-length", 0)))
+        response = self.transport.handle_request(request)
+        span.add("bytes_downloaded", int(response.headers.get("content-length", 0)))
+        return response
+
+    def trace(self, inner, event, info):
+        """httpcore trace hook: count new connections, then pass the event on to any hook already set."""
+        if event == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+        if inner is not None:
+            inner(event, info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass  # Closed by ServiceClients.close(), not by the per-request client
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        """Really close the pooled connections."""
+        self.transport.close()
+
+    def stats(self):
+        """Return request and new-connection counts for this pool."""
+        return {"requests": self.requests, "connections_opened": self.connections_opened}
+
+class ServiceClients:
+    """Long-lived, connection-pooled clients for Claude, Deepgram and Google TTS.
+
+    One instance is shared by every turn, so requests reuse warm keep-alive connections
+    instead of each paying for a new TCP and TLS handshake. The clients are created on first
+    use (usually by warm_up() in the background), not when talko is imported.
+    """
+
+    CLIENTS = ("anthropic_transport", "anthropic_http", "anthropic", "deepgram_transport", "gtts_session")
+
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.gtts_requests = 0
+        self.gtts_last_used = float("-inf")
+        self.warm_up_started = float("-inf")
+        self.warm_up_seconds = None
+        self.warm_up_failures = 0
+
+    def __getattr__(self, name):
+        # Only called for attributes that don't exist yet, i.e. clients not created so far
+        if name not in self.CLIENTS:
+            raise AttributeError(name)
+        self.create_clients()
+        return self.__dict__[name]
+
+    def create_clients(self):
+        with self.lock:
+            if "gtts_session" in self.__dict__:
+                return
+            anthropic_transport = PooledTransport(self.pool_size)
+            anthropic_http = anthropic.DefaultHttpxClient(transport=anthropic_transport)
+            # Retries and timeouts come from the stage policies, not the SDK's own defaults
+            self.anthropic = anthropic.Anthropic(http_client=anthropic_http, max_retries=0)
+            self.anthropic_transport, self.anthropic_http = anthropic_transport, anthropic_http
+
+            self.deepgram_transport = PooledTransport(self.pool_size)
+
+            gtts_session = requests.Session()
+            for scheme in ("https://", "http://"):
+                gtts_session.mount(scheme, requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size))
+            self.gtts_session = gtts_session  # Set last: marks the clients as created
+
+    def warm_up(self):
+        """Create the clients, open a connection to each service so the first real request skips
+        the handshake, and import the libraries the session will need next."""
+        started = time.perf_counter()
+        try:
+            self.anthropic_http.head(str(self.anthropic.base_url))
+        except httpx.HTTPError:
+            self.warm_up_failures += 1
+        try:
+            with httpx.Client(transport=self.deepgram_transport) as deepgram_http:
+                deepgram_http.head(deepgram.DeepgramClientOptions(url=DEEPGRAM_URL).url)
+        except httpx.HTTPError:
+            self.warm_up_failures += 1
+        try:
+            self.gtts_last_used = time.monotonic()
+            self.gtts_session.head(GTTS_URL + "/", timeout=10)
+        except requests.exceptions.RequestException:
+            self.warm_up_failures += 1
+        for module in WARM_UP_IMPORTS:
+            importlib.import_module(module)
+        self.warm_up_seconds = time.perf_counter() - started
+
+    def warm_up_in_background(self):
+        """Warm up connections on a daemon thread without blocking the caller."""
+        self.warm_up_started = time.monotonic()
+        threading.Thread(target=self.warm_up, daemon=True).start()
+
+    def idle_seconds(self):
+        """Seconds since the least recently used pool last sent a request (inf before the clients exist)."""
+        if "gtts_session" not in self.__dict__:
+            return float("inf")
+        last_used = min(self.anthropic_transport.last_used, self.deepgram_transport.last_used, self.gtts_last_used)
+        return time.monotonic() - last_used
+
+    def warm_up_if_idle(self):
+        """Warm up in the background if a pool's keep-alive connections may have expired since its last request."""
+        now = time.monotonic()
+        if self.idle_seconds() >= KEEPALIVE_SECONDS and now - self.warm_up_started >= KEEPALIVE_SECONDS:
+            self.warm_up_in_background()
+
+    def gtts_audio_parts(self, tts):
+        """Synthesize a gTTS object over the shared session, yielding one mp3 segment per text chunk as it arrives.
+
+        Mirrors gTTS.stream(), which would otherwise open a new requests.Session per request.
+        Each chunk's request runs under the "tts" stage policy (timeouts, retries, hedging).
+        """
+        for prepared_request in tts._prepare_requests():
+            if GTTS_URL != "https://translate.google.com":
+                prepared_request.url = GTTS_URL + prepared_request.path_url
+            yield stage_calls["tts"].call(functools.partial(self.gtts_request, tts, prepared_request))
+
+    def gtts_request(self, tts, prepared_request, timeout=30):
+        """Send one prepared gTTS request and return the decoded mp3 segment."""
+        self.gtts_requests += 1
+        self.gtts_last_used = time.monotonic()
+        current_span.get().add("gtts_requests")
+        try:
+            response = self.gtts_session.send(prepared_request, timeout=timeout)
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            raise gtts.gTTSError(tts=tts, response=response)
+        except requests.exceptions.Timeout as e:
+            raise DeadlineExceeded(f"Google TTS took longer than {timeout:.1f}s") from e
+        except requests.exceptions.RequestException:
+            raise gtts.gTTSError(tts=tts)
+
+        audio = b""
+        for line in response.iter_lines(chunk_size=1024):
+            decoded_line = line.decode("utf-8")
+            if tts.GOOGLE_TTS_RPC in decoded_line:
+                audio_search = re.search(r'jQ1olc","\[\\"(.*)\\"]', decoded_line)
+                if not audio_search:
+                    raise gtts.gTTSError(tts=tts, response=response)
+                audio += base64.b64decode(audio_search.group(1).encode("ascii"))
+        return audio
+
+    def stats(self):
+        """Return per-service request and connection-pool counts."""
+        gtts_connections = sum(adapter.poolmanager.pools[key].num_connections
+                               for adapter in self.gtts_session.adapters.values() for key in adapter.poolmanager.pools.keys())
+        return {
+            "anthropic": self.anthropic_transport.stats(),
+            "deepgram": self.deepgram_transport.stats(),
+            "gtts": {"requests": self.gtts_requests, "connections_opened": gtts_connections},
+            "warm_up_seconds": self.warm_up_seconds,
+            "warm_up_failures": self.warm_up_failures,
+        }
+
+    def close(self):
+        """Close every pooled connection."""
+        if "gtts_session" not in self.__dict__:
+            return  # Never used
+        self.anthropic.close()
+        self.anthropic_transport.shutdown()
+        self.deepgram_transport.shutdown()
+        self.gtts_session.close()
+
+service_clients = ServiceClients()
+
+def __getattr__(name):
+    # `talko.anthropic_client` is still available, created on first use like the other clients
+    if name == "anthropic_client":
+        return service_clients.anthropic
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def resize_service_pools(pool_size):
+    """Replace the shared service clients with ones keeping up to `pool_size` connections per service."""
+    global service_clients
+    service_clients.close()
+    service_clients = ServiceClients(pool_size)
+
+@dataclass
+class StagePolicy:
+    """Latency budget, retries and hedging for the calls one stage makes to an external service."""
+    timeout: float  # Seconds allowed for each attempt
+    budget: float  # Seconds allowed for the whole call, retries included
+    retries: int = 2  # Further attempts after a timeout or a transient error
+    backoff: float = 0.25  # Base of the exponential backoff between attempts, in seconds (full jitter)
+    hedge: bool = False  # Send a second request if the first is slower than usual, and take whichever finishes first
+    hedge_after: float = 2.0  # Seconds before hedging until enough calls have been seen to use their p95
+
+# Default policy per stage; override with --policy stage.field=value
+STAGE_POLICIES = {
+    "llm": StagePolicy(timeout=30.0, budget=60.0, hedge_after=10.0),
+    "stt": StagePolicy(timeout=10.0, budget=20.0, hedge_after=3.0),  # Hedging uploads every slow answer twice; opt in
+    "tts": StagePolicy(timeout=5.0, budget=12.0, hedge=True, hedge_after=1.5),
+}
+
+# Successful calls needed before a stage hedges at its observed p95 instead of hedge_after
+HEDGE_MIN_SAMPLES = 20
+
+class DeadlineExceeded(TimeoutError):
+    """An attempt or a whole call ran past its stage's time limit."""
+
+def is_retryable(error):
+    """Whether an error is worth another attempt: timeouts, connection failures, 429s and 5xxs."""
+    if isinstance(error, (DeadlineExceeded, anthropic.APIConnectionError, httpx.TransportError,
+                          requests.exceptions.ConnectionError, requests.exceptions.Timeout, websockets.WebSocketException)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        status = error.status_code
+    elif isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    elif isinstance(error, deepgram.DeepgramApiError):
+        status = int(error.status) if str(error.status).isdigit() else 0
+    elif isinstance(error, gtts.gTTSError):
+        status = error.rsp.status_code if error.rsp is not None else 503  # No response: couldn't connect
+    else:
+        return False
+    return status in (408, 409, 429) or status >= 500
+
+class StageCalls:
+    """Runs a stage's calls under its StagePolicy and counts timeouts, retries and hedges.
+
+    Attempts get the remaining time as their `timeout` argument and pass it on to their client,
+    so a timed-out request doesn't keep running. Hedged attempts run on their own threads;
+    the slower one is abandoned once the other succeeds.
+    """
+
+    def __init__(self, stage, policy):
+        self.stage = stage
+        self.policy = policy
+        self.latencies = deque(maxlen=200)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+        if counter in ("retries", "hedges", "timeouts"):
+            current_span.get().add(counter)
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging: the p95 of recent successful attempts, once there are enough."""
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return self.policy.hedge_after
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def call(self, attempt, hedge=None, hedgeable=True):
+        """Call attempt(timeout) until it succeeds, retrying transient errors with jittered backoff.
+
+        With hedging on (and `hedgeable`), `hedge(timeout)` (default: another `attempt`) is fired
+        if the first attempt is slower than usual. Raises the last error once retries or the budget run out.
+        """
+        policy = self.policy
+        deadline = time.perf_counter() + policy.budget
+        self.count("calls")
+        error = DeadlineExceeded(f"{self.stage} budget of {policy.budget:.1f}s exhausted")
+        for number in range(policy.retries + 1):
+            if number:
+                delay = random.uniform(0, policy.backoff * 2 ** (number - 1))
+                if time.perf_counter() + delay >= deadline:
+                    break
+                time.sleep(delay)
+                self.count("retries")
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            started = time.perf_counter()
+            try:
+                if policy.hedge and hedgeable:
+                    result = self.hedged(attempt, hedge or attempt, min(policy.timeout, remaining))
+                else:
+                    result = attempt(timeout=min(policy.timeout, remaining))
+            except Exception as e:
+                error = e
+                self.count("timeouts" if isinstance(e, (TimeoutError, httpx.TimeoutException, anthropic.APITimeoutError)) else "errors")
+                if not is_retryable(e):
+                    break
+            else:
+                with self.lock:
+                    self.latencies.append(time.perf_counter() - started)
+                return result
+        self.count("failures")
+        raise error
+
+    def hedged(self, attempt, hedge, timeout):
+        """Run `attempt`, firing `hedge` as well if it is slow, and return the first success."""
+        results = queue.Queue()
+
+        def run(name, function, timeout):
+            try:
+                results.put((name, function(timeout=timeout), None))
+            except Exception as e:
+                results.put((name, None, e))
+
+        def start(name, function, timeout):
+            threading.Thread(target=contextvars.copy_context().run, args=(run, name, function, timeout), daemon=True).start()
+
+        started = time.perf_counter()
+        end = started + timeout
+        start("first", attempt, timeout)
+        hedge_at = started + min(self.hedge_delay(), timeout)
+        pending, hedged, error = 1, False, None
+        while pending:
+            wait_until = end if hedged else hedge_at
+            try:
+                name, result, e = results.get(timeout=max(0.0, wait_until - time.perf_counter()))
+            except queue.Empty:
+                if hedged or time.perf_counter() >= end:
+                    raise DeadlineExceeded(f"{self.stage} took longer than {timeout:.1f}s")
+                hedged = True
+                pending += 1
+                self.count("hedges")
+                start("hedge", hedge, end - time.perf_counter())
+                continue
+            pending -= 1
+            if e is None:
+                if name == "hedge":
+                    self.count("hedge_wins")
+                return result
+            error = e
+            if not hedged:
+                # Fail fast and let call() decide whether to retry
+                raise error
+        raise error
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+stage_calls = {stage: StageCalls(stage, policy) for stage, policy in STAGE_POLICIES.items()}
+
+def configure_stage_policies(overrides):
+    """Apply "stage.field=value" overrides (e.g. "tts.hedge_after=0.8") to the stage policies."""
+    for override in overrides:
+        name, _, value = override.partition("=")
+        stage, _, field = name.partition(".")
+        types = {f.name: f.type for f in fields(StagePolicy)}
+        if stage not in stage_calls or field not in types or not value:
+            raise ValueError(f"Invalid policy override '{override}': expected stage.field=value with stage one of "
+                             f"{', '.join(stage_calls)} and field one of {', '.join(types)}")
+        kind = types[field]
+        parsed = value.lower() in ("1", "true", "yes", "on") if kind is bool else kind(value)
+        stage_calls[stage].policy = replace(stage_calls[stage].policy, **{field: parsed})
+
+class SpeechEndpointer:
+    """Energy and zero-crossing-rate voice activity detector that notices when the learner stops talking.
+
+    Audio is analyzed in short frames. A frame counts as speech when its level is well above the
+    running noise floor, or slightly above it with a high zero-crossing rate (unvoiced sounds like "s").
+    The floor starts `margin_db` below `threshold_db` and only follows frames quieter than `threshold_db`,
+    so a learner who starts talking right away isn't mistaken for background noise.
+    Once speech has started, `hangover` seconds of silence end the utterance.
+    """
+
+    def __init__(self, hangover=1.0, frame_ms=20, min_speech=0.15, padding=0.2, threshold_db=-50.0, margin_db=12.0):
+        self.hangover = hangover
+        self.frame_ms = frame_ms
+        self.min_speech = min_speech
+        self.padding = padding
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.start(STT_SAMPLE_RATE)
+
+    def start(self, sample_rate):
+        """Reset state for a new recording at the given sample rate."""
+        self.sample_rate = sample_rate
+        self.frame_length = max(1, sample_rate * self.frame_ms // 1000)
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.position = 0
+        self.noise_db = self.threshold_db - self.margin_db
+        self.speech_run = 0
+        self.silence_run = 0
+        self.speech_start = None
+        self.speech_end = None
+        self.done = False
+
+    def is_speech(self, frame):
+        """Classify one frame, updating the noise floor from frames quieter than threshold_db."""
+        level_db = 20 * np.log10(np.sqrt(np.mean(np.square(frame))) + 1e-10)
+        zero_crossing_rate = np.count_nonzero(np.diff(np.signbit(frame))) / len(frame)
+        threshold = max(self.threshold_db, self.noise_db + self.margin_db)
+        speech = level_db > threshold or (level_db > threshold - self.margin_db / 2 and zero_crossing_rate > 0.25)
+        if level_db < self.threshold_db:
+            # Too quiet to be voiced speech, so it tells us about the noise even if its zero-crossing rate counted it.
+            # Follow drops in background noise immediately and rises slowly
+            self.noise_db = min(level_db, self.noise_db + 0.05 * (level_db - self.noise_db))
+        return speech
+
+    def process(self, block):
+        """Feed a block of audio; returns True once the utterance has ended."""
+        frames = np.concatenate([self.pending, downmix(block).astype(np.float32, copy=False)])
+        usable = len(frames) - len(frames) % self.frame_length
+        self.pending = frames[usable:]
+        for frame in frames[:usable].reshape(-1, self.frame_length):
+            frame_start = self.position
+            self.position += self.frame_length
+            if self.is_speech(frame):
+                self.speech_run += 1
+                self.silence_run = 0
+                if self.speech_start is None and self.speech_run * self.frame_length >= self.min_speech * self.sample_rate:
+                    self.speech_start = frame_start - (self.speech_run - 1) * self.frame_length
+                if self.speech_start is not None:
+                    self.speech_end = self.position
+            else:
+                self.speech_run = 0
+                if self.speech_start is not None:
+                    self.silence_run += 1
+                    if self.silence_run * self.frame_length >= self.hangover * self.sample_rate:
+                        self.done = True
+        return self.done
+
+    def speech_span(self, total_samples):
+        """Return (start, end) sample indices of the detected speech plus padding, or the whole recording if none was heard."""
+        if self.speech_start is None:
+            return 0, total_samples
+        padding = int(self.padding * self.sample_rate)
+        return max(0, self.speech_start - padding), min(total_samples, self.speech_end + padding)
+
+def capture_blocks(sample_rate, handle_block, stop=None, max_queued_blocks=256, endpointer=None):
+    """Feed microphone blocks to `handle_block` until Ctrl+C, or until `stop` (a threading.Event) is set.
+
+    Blocks from the audio callback go through a bounded queue; if handle_block falls behind,
+    new blocks are dropped (and counted) rather than growing memory without limit.
+    With an `endpointer` (a SpeechEndpointer), recording also ends after a pause in speech.
+    """
+    q = queue.Queue(maxsize=max_queued_blocks)
+    dropped_blocks = 0
+    endpoint = threading.Event()
+    if endpointer is not None:
+        endpointer.start(sample_rate)
 
     def callback(indata, frames, time, status):
+        nonlocal dropped_blocks
         if status:
             print(status, file=sys.stderr)
-        q.put(indata.copy())
+        try:
+            q.put_nowait(indata.copy())
+        except queue.Full:
+            dropped_blocks += 1
+        if endpointer is not None and not endpoint.is_set() and endpointer.process(indata):
+            endpoint.set()
 
     try:
-        device_info = sd.query_devices(None, "input")
-        sample_rate = int(device_info["default_samplerate"])
-        filename = "recording.wav"
-
-        with sf.SoundFile(filename, mode="w", samplerate=sample_rate, channels=1) as file:
-            with sd.InputStream(samplerate=sample_rate, channels=1, callback=callback):
+        with sd.InputStream(samplerate=sample_rate, channels=1, callback=callback):
+            if endpointer is not None:
+                print("Recording stops after a pause (or press Ctrl+C)")
+            else:
                 print("Press Ctrl+C to stop recording")
-                while True:
-                    file.write(q.get())
+            while not endpoint.is_set() and (stop is None or not stop.is_set()):
+                try:
+                    block = q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                handle_block(block)
     except KeyboardInterrupt:
-        print("\nRecording finished: " + repr(filename))
+        pass
+    while not q.empty():
+        handle_block(q.get_nowait())
+
+    if dropped_blocks:
+        print(f"{Fore.RED}Warning: dropped {dropped_blocks} audio blocks while recording{Style.RESET_ALL}")
+
+def record_speech(stop=None, endpointer=None, filename="recording.wav"):
+    """Record user speech and save as wav file."""
+    device_info = sd.query_devices(None, "input")
+    sample_rate = int(device_info["default_samplerate"])
+
+    with tracer.span("record", capture="file") as span:
+        with sf.SoundFile(filename, mode="w", samplerate=sample_rate, channels=1) as file:
+            capture_blocks(sample_rate, file.write, stop, endpointer=endpointer)
+            total_frames = file.frames
+        start, end = endpointer.speech_span(total_frames) if endpointer is not None else (0, total_frames)
+        if (start, end) != (0, total_frames):
+            samples, _ = sf.read(filename, start=start, stop=end)
+            sf.write(filename, samples, sample_rate)
+        span.set(audio_seconds=(end - start) / sample_rate, audio_bytes=os.path.getsize(filename))
+    print("\nRecording finished: " + repr(filename))
 
     return filename
 
-def get_random_word():
-    """Get a random word from the macOS words file."""
+class AudioBuffer:
+    """Preallocated mono float32 recording buffer that doubles in size when full."""
+
+    def __init__(self, initial_frames):
+        self.data = np.zeros(initial_frames, dtype=np.float32)
+        self.length = 0
+
+    def append(self, block):
+        """Append a block of frames, downmixing to mono if needed."""
+        block = downmix(block)
+        end = self.length + len(block)
+        if end > len(self.data):
+            grown = np.zeros(max(end, 2 * len(self.data)), dtype=np.float32)
+            grown[:self.length] = self.data[:self.length]
+            self.data = grown
+        self.data[self.length:end] = block
+        self.length = end
+
+    def samples(self):
+        """Return the recorded samples (a view, not a copy)."""
+        return self.data[:self.length]
+
+def downmix(block):
+    """Average a (frames, channels) block down to mono."""
+    if block.ndim == 2:
+        return block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+    return block
+
+def resample(samples, sample_rate, target_rate):
+    """Resample mono audio, averaging groups of samples first when decimating by an integer factor."""
+    if sample_rate == target_rate or len(samples) == 0:
+        return samples
+    if sample_rate % target_rate == 0:
+        # Box-filter and decimate (e.g. 48 kHz -> 16 kHz), which keeps aliasing down for speech
+        factor = sample_rate // target_rate
+        usable = len(samples) - len(samples) % factor
+        return samples[:usable].reshape(-1, factor).mean(axis=1)
+    duration = len(samples) / sample_rate
+    target_times = np.arange(int(duration * target_rate)) / target_rate
+    source_times = np.arange(len(samples)) / sample_rate
+    return np.interp(target_times, source_times, samples).astype(np.float32)
+
+class StreamResampler:
+    """Resample mono audio that arrives in blocks of any size as one continuous signal.
+
+    resample() drops the samples that don't make up a whole output sample, which is harmless
+    once per recording but loses audio at every boundary when applied block by block. This
+    carries those input samples, and the position of the next output sample, into the next block.
+    """
+
+    def __init__(self, sample_rate, target_rate):
+        self.sample_rate = sample_rate
+        self.target_rate = target_rate
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.consumed = 0  # Input samples before `pending`
+        self.produced = 0  # Output samples returned so far
+
+    def process(self, samples):
+        """Resample the next block, returning the output samples it completes."""
+        if self.sample_rate == self.target_rate:
+            return samples
+        samples = np.concatenate([self.pending, samples.astype(np.float32, copy=False)])
+        if self.sample_rate % self.target_rate == 0:
+            factor = self.sample_rate // self.target_rate
+            usable = len(samples) - len(samples) % factor
+            self.pending = samples[usable:]
+            return samples[:usable].reshape(-1, factor).mean(axis=1)
+        # Output sample n sits at input position n * sample_rate / target_rate; interpolate those up to the last input sample
+        last_input = self.consumed + len(samples) - 1
+        end = (last_input * self.target_rate) // self.sample_rate + 1
+        positions = np.arange(self.produced, end) * self.sample_rate / self.target_rate - self.consumed
+        resampled = np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+        self.produced = max(self.produced, end)
+        keep_from = min(len(samples), self.produced * self.sample_rate // self.target_rate - self.consumed)
+        self.pending = samples[keep_from:]
+        self.consumed += keep_from
+        return resampled
+
+def to_pcm16(samples):
+    """Convert float samples in [-1, 1] to int16."""
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+
+def encode_audio(samples, sample_rate, audio_format="flac", target_rate=STT_SAMPLE_RATE):
+    """Resample to the STT rate and encode as 16-bit FLAC (or Opus) bytes in memory."""
+    pcm = to_pcm16(resample(samples, sample_rate, target_rate))
+    file_format, subtype = AUDIO_FORMATS[audio_format]
+    encoded = io.BytesIO()
+    sf.write(encoded, pcm, target_rate, format=file_format, subtype=subtype)
+    return encoded.getvalue()
+
+def record_speech_to_memory(audio_format="flac", stop=None, endpointer=None):
+    """Record user speech into memory and return it encoded for upload, trimmed to the speech if endpointing."""
+    device_info = sd.query_devices(None, "input")
+    sample_rate = int(device_info["default_samplerate"])
+    recording = AudioBuffer(30 * sample_rate)
+
+    with tracer.span("record", capture="memory", audio_format=audio_format) as span:
+        capture_blocks(sample_rate, recording.append, stop, endpointer=endpointer)
+
+        start, end = endpointer.speech_span(recording.length) if endpointer is not None else (0, recording.length)
+        audio = encode_audio(recording.samples()[start:end], sample_rate, audio_format)
+        span.set(audio_seconds=(end - start) / sample_rate, audio_bytes=len(audio))
+    print(f"\nRecording finished: {(end - start) / sample_rate:.1f}s, {len(audio) / 1024:.1f} KB {audio_format}")
+    return audio
+
+class WordSampler:
+    """Draw random lines from a word list through a memory map and a cached line-offset index."""
+
+    INDEX_SUFFIX = ".offsets.npy"
+    MAX_ATTEMPTS = 1000
+
+    def __init__(self, path, index_dir=None):
+        self.path = path
+        self.index_dir = index_dir or os.path.join(DEFAULT_CACHE_DIR, "words")
+        self._map = None
+        self.offsets = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Map the word list and load (or build) its offset index."""
+        with self.lock:
+            if self._map is None:
+                with open(self.path, 'rb') as word_file:
+                    self._map = mmap.mmap(word_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.offsets = self._load_index()
+        return self
+
+    def _index_paths(self):
+        name = os.path.basename(self.path) + self.INDEX_SUFFIX
+        return [os.path.join(os.path.dirname(os.path.abspath(self.path)), name),
+                os.path.join(self.index_dir, hashlib.sha256(os.path.abspath(self.path).encode()).hexdigest()[:16] + "-" + name)]
+
+    def _load_index(self):
+        """Return line start offsets, reusing an index file whose stamp matches the word list."""
+        stat = os.stat(self.path)
+        stamp = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+        for index_path in self._index_paths():
+            try:
+                index = np.load(index_path, mmap_mode='r')
+                if len(index) >= 3 and np.array_equal(index[:2], stamp):
+                    return index[2:]
+            except (OSError, ValueError):
+                continue
+
+        offsets = self._build_offsets()
+        for index_path in self._index_paths():
+            try:
+                os.makedirs(os.path.dirname(index_path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), suffix=".tmp")
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, np.concatenate([stamp, offsets]))
+                os.replace(tmp_path, index_path)
+                break
+            except OSError:
+                continue
+        return offsets
+
+    def _build_offsets(self):
+        """Scan the word list once for line starts; the last entry is the end of the file."""
+        size = len(self._map)
+        if size == 0:
+            return np.zeros(1, dtype=np.int64)
+        data = np.frombuffer(self._map, dtype=np.uint8)
+        starts = np.flatnonzero(data == ord('\n')) + 1
+        del data
+        if starts.size == 0 or starts[-1] != size:
+            starts = np.append(starts, size)
+        return np.concatenate([[0], starts]).astype(np.int64)
+
+    def __len__(self):
+        self.open()
+        return len(self.offsets) - 1
+
+    def word_at(self, i):
+        """Return the word on line i, without any trailing frequency column."""
+        self.open()
+        line = self._map[int(self.offsets[i]):int(self.offsets[i + 1])]
+        fields = line.decode('utf-8', errors='replace').split()
+        return fields[0] if fields else ""
+
+    def sample(self, min_length=1, max_length=None, max_rank=None):
+        """Draw a random word, optionally limited by length and to the max_rank first (most frequent) lines."""
+        count = len(self)
+        if max_rank:
+            count = min(count, max_rank)
+        for _ in range(self.MAX_ATTEMPTS if count else 0):
+            word = self.word_at(random.randrange(count))
+            if len(word) >= min_length and (max_length is None or len(word) <= max_length):
+                return word
+        raise LookupError(f"No word of length {min_length}-{max_length or 'any'} found in {self.path}")
+
+    def close(self):
+        with self.lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+                self.offsets = None
+
+@functools.lru_cache(maxsize=None)
+def word_sampler(path):
+    """Return the shared sampler for a word list file."""
+    return WordSampler(path)
+
+def word_list_path(lang="en"):
+    """Return the word list for a language, falling back to the system dictionary."""
+    path = os.path.join(WORD_LIST_DIR, f"{lang}.txt")
+    return path if os.path.exists(path) else DICTIONARY_PATH
+
+def get_random_word(lang="en", min_length=1, max_length=None, max_rank=None):
+    """Get a random word from the language's word list (or the macOS words file)."""
     try:
-        with open('/usr/share/dict/words', 'r') as word_file:
-            words = word_file.read().splitlines()
-        return random.choice(words).lower()
+        return word_sampler(word_list_path(lang)).sample(min_length, max_length, max_rank).lower()
     except Exception as e:
         print(f"{Fore.RED}Error getting random word: {e}{Style.RESET_ALL}")
         return "default"
 
-def speech_to_text(filename, lang="en"):
-    """Convert speech to text using Deepgram Nova 2."""
+def make_deepgram_client():
+    """Create a Deepgram client, honoring the DEEPGRAM_URL override."""
+    return deepgram.DeepgramClient(config=deepgram.DeepgramClientOptions(url=DEEPGRAM_URL))
+
+def report_transcript(transcript):
+    """Print a transcript and return it, or the placeholder used when nothing was said."""
+    if not transcript.strip():
+        print("\nNo speech detected")
+        return "(no speech detected)"
+
+    print("\nTranscription:")
+    print("-" * 80)
+    print(transcript)
+    print("-" * 80)
+
+    return transcript.strip()
+
+def speech_to_text(audio, lang="en"):
+    """Convert speech to text using Deepgram Nova 2.
+
+    `audio` is either the path of a recorded file or already-encoded audio bytes.
+    """
     print("Converting speech to text with Deepgram Nova 2...")
-    try:
-        # Initialize Deepgram client
-        deepgram = DeepgramClient()
+    with tracer.span("stt", mode="prerecorded") as span:
+        try:
+            # Initialize Deepgram client
+            client = make_deepgram_client()
+        
+            if isinstance(audio, bytes):
+                buffer_data = audio
+            else:
+                # Read the audio file
+                print(f"Reading audio file: {audio}")
+                with open(audio, "rb") as file:
+                    buffer_data = file.read()
         
-        # Read the audio file
-        print(f"Reading audio file: {filename}")
-        with open(filename, "rb") as file:
-            buffer_data = file.read()
+            # Get the appropriate language code or default to en-US
+            language = DEEPGRAM_LANG_CODES.get(lang, 'en-US')
+            print(f"Using language: {language}")
         
-        # Get the appropriate language code or default to en-US
-        language = DEEPGRAM_LANG_CODES.get(lang, 'en-US')
-        print(f"Using language: {language}")
+            # Configure options and transcribe
+            options = deepgram.PrerecordedOptions(
+                model="nova-2",
+                smart_format=True,
+                language=language
+            )
         
-        # Configure options and transcribe
-        options = PrerecordedOptions(
+            response = stage_calls["stt"].call(lambda timeout: client.listen.rest.v("1").transcribe_file(
+                {"buffer": buffer_data}, options, transport=service_clients.deepgram_transport, timeout=httpx.Timeout(timeout)
+            ))
+            transcript = response["results"]["channels"][0]["alternatives"][0]["transcript"]
+            span.set(audio_bytes=len(buffer_data), transcript_chars=len(transcript))
+            return report_transcript(transcript)
+        
+        except Exception as e:
+            span.set(error=type(e).__name__)
+            print(f"Error during transcription: {type(e).__name__}: {str(e)}")
+            return "(error in speech recognition)"
+
+def record_and_transcribe_live(lang="en", audio_format="flac", stop=None, finalize_timeout=3.0, endpointer=None):
+    """Stream speech to Deepgram's live API while recording, so the transcript is ready when the learner stops.
+
+    Audio blocks are downmixed, resampled to 16 kHz linear16 and forwarded as they arrive.
+    If the live connection can't be opened, falls back to recording in memory and transcribing afterwards.
+    """
+    print("Streaming speech to Deepgram Nova 2...")
+    language = DEEPGRAM_LANG_CODES.get(lang, 'en-US')
+    print(f"Using language: {language}")
+
+    final_transcripts = []
+    finalized = threading.Event()
+
+    def on_transcript(connection, result, **kwargs):
+        if result.is_final:
+            final_transcripts.append(result.channel.alternatives[0].transcript.strip())
+        if result.from_finalize:
+            finalized.set()
+
+    def on_close(connection, close, **kwargs):
+        finalized.set()
+
+    try:
+        connection = make_deepgram_client().listen.websocket.v("1")
+        connection.on(deepgram.LiveTranscriptionEvents.Transcript, on_transcript)
+        connection.on(deepgram.LiveTranscriptionEvents.Close, on_close)
+        options = deepgram.LiveOptions(
             model="nova-2",
             smart_format=True,
-            language=language
+            language=language,
+            encoding="linear16",
+            sample_rate=STT_SAMPLE_RATE,
+            channels=1
         )
-        
-        response = deepgram.listen.rest.v("1").transcribe_file({"buffer": buffer_data}, options)
-        transcript = response["results"]["channels"][0]["alternatives"][0]["transcript"]
-        
-        if not transcript.strip():
-            print("\nNo speech detected")
-            return "(no speech detected)"
-            
-        print("\nTranscription:")
-        print("-" * 80)
-        print(transcript)
-        print("-" * 80)
-        
-        return transcript.strip()
-        
+        if not connection.start(options):
+            raise ConnectionError("could not open live transcription connection")
     except Exception as e:
-        print(f"Error during transcription: {str(e)}")
-        return "(error in speech recognition)"
+        print(f"Live transcription unavailable ({e}). Falling back to recording first.")
+        return speech_to_text(record_speech_to_memory(audio_format, stop, endpointer), lang)
 
+    bytes_sent = 0
+    resampler = None
 
-def query_claude(messages, system_prompt):
-    """Get response from Claude 3.5 Sonnet."""
-    print("Getting response from Claude 3.5 Sonnet...")
-    response = anthropic_client.messages.create(
-        model="claude-3-5-sonnet-latest",
-        max_tokens=1000,
-        temperature=0.7,
-        system=system_prompt,
-        messages=messages
-    )
-    return response.content[0].text
+    def finish_in_background():
+        # finish() joins the SDK's keep-alive and listener threads, which takes about half a second;
+        # the transcript doesn't depend on it, so don't make the learner wait for it
+        threading.Thread(target=connection.finish, daemon=True).start()
 
-def text_to_speech_google(text, lang):
-    """Convert text to speech using Google TTS (gTTS) with language fallbacks."""
-    print("Converting text to speech with Google TTS...")
-    available_langs = tts_langs()
+    def send(block):
+        nonlocal bytes_sent
+        data = to_pcm16(resampler.process(downmix(block))).tobytes()
+        bytes_sent += len(data)
+        connection.send(data)
+
+    with tracer.span("stt", mode="live") as span:
+        try:
+            device_info = sd.query_devices(None, "input")
+            sample_rate = int(device_info["default_samplerate"])
+            resampler = StreamResampler(sample_rate, STT_SAMPLE_RATE)
+            with tracer.span("record", capture="live"):
+                capture_blocks(sample_rate, send, stop, endpointer=endpointer)
+            print("\nRecording finished")
+
+            # Ask Deepgram to flush whatever it is still holding, then wait for those last results
+            finalize_started = time.perf_counter()
+            connection.finalize()
+            finalized.wait(finalize_timeout)
+            span.set(finalize_ms=(time.perf_counter() - finalize_started) * 1000)
+            finish_in_background()
+            transcript = " ".join(t for t in final_transcripts if t)
+            span.set(bytes_uploaded=bytes_sent, transcript_chars=len(transcript))
+            return report_transcript(transcript)
+
+        except Exception as e:
+            span.set(error=type(e).__name__, bytes_uploaded=bytes_sent)
+            finish_in_background()
+            print(f"Error during transcription: {str(e)}")
+            return "(error in speech recognition)"
+
+
+def create_message(messages, system_prompt, **kwargs):
+    """Send a request to Claude 3.5 Sonnet with the tutor's settings and return the full Message."""
+    with tracer.span("llm", stream=False) as span:
+        message = stage_calls["llm"].call(lambda timeout: service_clients.anthropic.messages.create(
+            model=CLAUDE_MODEL,
+            max_tokens=1000,
+            temperature=0.7,
+            system=system_prompt,
+            messages=messages,
+            timeout=timeout,
+            **kwargs
+        ))
+        record_usage(span, message.usage)
+    return message
+
+def query_claude(messages, system_prompt, cache_site=None):
+    """Get response from Claude 3.5 Sonnet.
+
+    If the response cache is enabled for `cache_site`, the reply may be a cached one (see ResponseCache).
+    """
+    print("Getting response from Claude 3.5 Sonnet...")
+    return cached_reply(cache_site, system_prompt, messages, lambda: create_message(messages, system_prompt).content[0].text)
+
+def cached_reply(site, system_prompt, messages, generate, on_hit=None):
+    """Return a cached reply for this request if `site` is enabled and has one, else generate() and cache its reply."""
+    key, reply = llm_cache.lookup(site, system_prompt, messages)
+    if reply is not None:
+        if on_hit is not None:
+            on_hit()
+        return reply
+    reply = generate()
+    if key is not None:
+        llm_cache.put(key, site, reply)
+    return reply
+
+def cached_stream(site, system_prompt, messages, stream, on_hit=None):
+    """Streaming counterpart of cached_reply: yields a cached reply in one piece, or streams stream() and caches the result."""
+    key, reply = llm_cache.lookup(site, system_prompt, messages)
+    if reply is not None:
+        if on_hit is not None:
+            on_hit()
+        yield reply
+        return
+    parts = []
+    for text in stream():
+        parts.append(text)
+        yield text
+    if key is not None:
+        llm_cache.put(key, site, "".join(parts))
+
+def stream_claude(messages, system_prompt, on_message=None, **kwargs):
+    """Stream a response from Claude 3.5 Sonnet, yielding text as it arrives.
+
+    If given, `on_message` is called with the final Message (including usage) once the stream ends.
+    Failures before the first text arrives are retried under the "llm" stage policy; once text
+    has been yielded (and perhaps spoken) an error ends the stream.
+    """
+    print("Streaming response from Claude 3.5 Sonnet...")
+
+    def open_stream(timeout):
+        with ExitStack() as stack:
+            stream = stack.enter_context(service_clients.anthropic.messages.stream(
+                model=CLAUDE_MODEL,
+                max_tokens=1000,
+                temperature=0.7,
+                system=system_prompt,
+                messages=messages,
+                timeout=timeout,
+                **kwargs
+            ))
+            texts = iter(stream.text_stream)
+            first_text = next(texts, None)
+            return stack.pop_all(), stream, texts, first_text
+
+    with tracer.span("llm", stream=True) as span:
+        started = time.perf_counter()
+        # An abandoned hedge would leave a stream open, so streams are only retried
+        stack, stream, texts, first_text = stage_calls["llm"].call(open_stream, hedgeable=False)
+        with stack:
+            if first_text is not None:
+                span.set(first_text_ms=(time.perf_counter() - started) * 1000)
+                yield first_text
+                yield from texts
+            message = stream.get_final_message()
+        record_usage(span, message.usage)
+        if on_message is not None:
+            on_message(message)
+
+class Conversation:
+    """The messages of one lesson or test, sent with prompt-cache breakpoints and kept within a token budget.
+
+    The system prompt, the opening request and the latest user turns are marked as cache
+    breakpoints, so each request re-reads the stable prefix from the prompt cache. Once a
+    request's input exceeds `context_budget` tokens, older turns are folded into a rolling
+    summary attached to the opening request, so late turns cost about as much as early ones.
+    Compaction may run on a worker thread while turns are added; `lock` guards the messages and summary.
+    """
+
+    def __init__(self, system_prompt, opening_message, context_budget=8000, keep_messages=8, prompt_cache=True, cache_site=None):
+        self.system_prompt = system_prompt
+        self.messages = [{"role": "user", "content": opening_message}]
+        self.summary = ""
+        self.context_budget = context_budget
+        self.keep_messages = keep_messages
+        self.prompt_cache = prompt_cache
+        self.cache_site = cache_site  # Response cache call site for the opening reply, which is the same for every learner
+        self.turn_stats = []
+        self.lock = threading.Lock()
+
+    def add(self, role, content):
+        """Append a message to the conversation."""
+        with self.lock:
+            self.messages.append({"role": role, "content": content})
+
+    def request(self):
+        """Build the system and messages arguments for the next request."""
+        with self.lock:
+            messages = [dict(message) for message in self.messages]
+            summary = self.summary
+        if summary:
+            messages[0]["content"] += f"\n\n[Summary of the lesson so far: {summary}]"
+        if not self.prompt_cache:
+            return {"system": self.system_prompt, "messages": messages}
+
+        # Breakpoints: the opening request (plus summary) and the two latest user turns
+        user_indexes = [i for i, message in enumerate(messages) if message["role"] == "user"]
+        for i in {0, *user_indexes[-2:]}:
+            messages[i]["content"] = [{"type": "text", "text": messages[i]["content"], "cache_control": CACHE_CONTROL}]
+        return {
+            "system": [{"type": "text", "text": self.system_prompt, "cache_control": CACHE_CONTROL}],
+            "messages": messages,
+            "extra_headers": {"anthropic-beta": PROMPT_CACHING_BETA},
+        }
+
+    def response_cache_site(self):
+        """The response cache call site for the next request; only the opening reply is shared between learners."""
+        return self.cache_site if len(self.messages) == 1 and not self.summary else None
+
+    def query(self):
+        """Get the next reply from Claude."""
+        print("Getting response from Claude 3.5 Sonnet...")
+        started = time.perf_counter()
+
+        def generate():
+            request = self.request()
+            message = create_message(request.pop("messages"), request.pop("system"), **request)
+            self.record(message, started, time.perf_counter() - started)
+            return message.content[0].text
+
+        return cached_reply(self.response_cache_site(), self.system_prompt, self.messages, generate,
+                            on_hit=lambda: self.record(None, started, time.perf_counter() - started))
+
+    def stream(self):
+        """Stream the next reply from Claude, yielding text as it arrives."""
+        started = time.perf_counter()
+        first_token = None
+        request = self.request()
+        on_message = lambda message: self.record(message, started, first_token)
+        texts = cached_stream(self.response_cache_site(), self.system_prompt, self.messages,
+                              lambda: stream_claude(request.pop("messages"), request.pop("system"), on_message, **request),
+                              on_hit=lambda: self.record(None, started, time.perf_counter() - started))
+        for text in texts:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            yield text
+
+    def record(self, message, started, first_token):
+        """Record token counts and latency for the request that produced `message` (None for a cached reply)."""
+        usage = message.usage if message is not None else None
+        stats = {
+            "turn": len(self.turn_stats) + 1,
+            "cached": message is None,
+            "input_tokens": usage.input_tokens if usage else 0,
+            "cache_read_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+            "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+            "output_tokens": usage.output_tokens if usage else 0,
+            "first_token_seconds": first_token,
+            "total_seconds": time.perf_counter() - started,
+        }
+        self.turn_stats.append(stats)
+
+    def print_turn_stats(self):
+        """Print token counts and latency for the latest request."""
+        if self.turn_stats and self.turn_stats[-1]["cached"]:
+            print(f"{Style.DIM}(turn {self.turn_stats[-1]['turn']}: reply from the response cache){Style.RESET_ALL}")
+        elif self.turn_stats:
+            stats = self.turn_stats[-1]
+            print(f"{Style.DIM}(turn {stats['turn']}: {stats['input_tokens']} input tokens, "
+                  f"{stats['cache_read_tokens']} read from cache, {stats['cache_write_tokens']} written to cache; "
+                  f"first token after {stats['first_token_seconds']:.2f}s){Style.RESET_ALL}")
+
+    def needs_compaction(self):
+        """Whether the last request went over the context budget."""
+        if not self.context_budget or not self.turn_stats:
+            return False
+        last = self.turn_stats[-1]
+        return last["input_tokens"] + last["cache_read_tokens"] + last["cache_write_tokens"] > self.context_budget
+
+    def compact(self):
+        """Fold older turns into the rolling summary, keeping the opening request and the latest messages.
+
+        Summarizes a snapshot of the messages, so turns added meanwhile are kept when the summary is swapped in.
+        """
+        with self.lock:
+            messages = list(self.messages)
+            summary = self.summary
+        cut = len(messages) - self.keep_messages
+        # The kept messages must start with a reply so that roles still alternate after the opening request
+        if cut > 1 and messages[cut]["role"] != "assistant":
+            cut -= 1
+        if cut <= 1:
+            return
+
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages[1:cut])
+        print(f"{Style.DIM}(summarizing {cut - 1} older messages to keep the context small){Style.RESET_ALL}")
+        summary = query_claude(
+            [{"role": "user", "content": f"""Summary so far: {summary or 'None yet.'}
+
+Newer turns:
+{transcript}
+
+Write an updated summary in a few sentences: what has been covered, the student's recurring mistakes, and where the lesson currently stands."""}],
+            "You summarize language lessons between a tutor (assistant) and a student (user) so the lesson can continue without the full transcript."
+        )
+        with self.lock:
+            # Only messages are ever appended meanwhile, so the first `cut` are still the summarized ones
+            self.summary = summary
+            self.messages = [self.messages[0]] + self.messages[cut:]
+
+    def print_summary(self):
+        """Print how token counts and latency evolved over the session."""
+        if not self.turn_stats:
+            return
+        cached = sum(stats["cache_read_tokens"] for stats in self.turn_stats)
+        total = sum(stats["input_tokens"] + stats["cache_read_tokens"] + stats["cache_write_tokens"] for stats in self.turn_stats)
+        first, last = self.turn_stats[0], self.turn_stats[-1]
+        print(f"{Style.DIM}Prompt cache: {cached} of {total} input tokens read from cache. "
+              f"First turn: {first['input_tokens'] + first['cache_read_tokens'] + first['cache_write_tokens']} tokens, "
+              f"{first['total_seconds']:.2f}s; last turn: "
+              f"{last['input_tokens'] + last['cache_read_tokens'] + last['cache_write_tokens']} tokens, "
+              f"{last['total_seconds']:.2f}s{Style.RESET_ALL}")
+
+def split_sentences(buffer):
+    """Split finished sentences off the front of a streamed buffer.
+
+    Returns (sentences, remainder). Boundaries inside [square brackets] are ignored so
+    that an annotation is never cut in half.
+    """
+    sentences = []
+    start = 0
+    for match in SENTENCE_BOUNDARY_RE.finditer(buffer):
+        candidate = buffer[start:match.end()]
+        if candidate.count('[') > candidate.count(']'):
+            continue  # Still inside an annotation
+        sentences.append(candidate.strip())
+        start = match.end()
+    return sentences, buffer[start:]
+
+def strip_annotations(text):
+    """Remove [square bracket] annotations so only the target language is read aloud."""
+    spoken_text = re.sub(r'\s*\[.*?\]\s*', ' ', text)  # Remove brackets and their content, handling whitespace
+    spoken_text = re.sub(r'\s+', ' ', spoken_text)  # Clean up any double spaces
+    return spoken_text.strip()  # Remove leading/trailing whitespace
+
+class AudioCache:
+    """Content-addressed cache of synthesized speech with LRU eviction under a byte budget.
+
+    Entries are keyed by (normalized text, TTS language, backend) and stored as one file each
+    (Google TTS entries hold the reply's mp3 segments, joined with pack_segments()).
+    Writes go through a temp file and an atomic rename, and eviction holds an exclusive lock,
+    so several talko processes can share one cache directory. Recency is tracked via mtime.
+    """
+
+    SUFFIX = ".segments"  # Entries are packed segments, not playable mp3 files
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = None  # Computed lazily on the first write
+
+    @staticmethod
+    def normalize(text):
+        """Normalize text so trivially different spellings share a cache entry."""
+        return re.sub(r'\s+', ' ', unicodedata.normalize("NFC", text)).strip()
+
+    def path_for(self, text, tts_lang, backend):
+        """Return the cache file path for a piece of speech."""
+        key = json.dumps([backend, tts_lang, self.normalize(text)], ensure_ascii=False)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}{self.SUFFIX}")
+
+    def get(self, text, tts_lang, backend):
+        """Return cached audio bytes, or None on a miss."""
+        if self.max_bytes <= 0:
+            return None
+        path = self.path_for(text, tts_lang, backend)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return audio
+
+    def put(self, text, tts_lang, backend, audio):
+        """Store audio bytes and evict the least recently used entries if over budget."""
+        if self.max_bytes <= 0 or len(audio) > self.max_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path_for(text, tts_lang, backend)
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False) as temp_file:
+            temp_file.write(audio)
+        os.replace(temp_file.name, path)
+
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _ in self._entries())
+        else:
+            self.total_bytes += len(audio)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits its byte budget."""
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Rescan under the lock, since other processes may have added or evicted entries
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            self.total_bytes = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def _entries(self):
+        """Yield (path, size, mtime) for every cached clip."""
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(self.SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def stats(self):
+        """Return hit/miss counters for reporting."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+tts_cache = AudioCache(os.path.join(DEFAULT_CACHE_DIR, "tts"))
+
+class ResponseCache:
+    """Persistent cache of Claude replies to requests that repeat across sessions, enabled per call site.
+
+    Entries are keyed by a hash of the model, system prompt and messages. Each key holds a pool
+    of up to `variants` replies: until the pool is full, requests still go to Claude and each
+    reply joins the pool; after that a random variant is served, so learners keep seeing some
+    variety. Replies expire `ttl` seconds after they were generated, and the least recently used
+    ones are evicted once the stored text exceeds `max_bytes`. The cache is a SQLite database,
+    so several talko processes can share it.
+    """
+
+    def __init__(self, path, sites=(), variants=3, ttl=7 * 24 * 3600, max_bytes=20 * 1024 * 1024):
+        self.path = path
+        self.sites = set(sites)
+        self.variants = variants
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.counters = defaultdict(int)  # (site, "hits" / "misses") and "expirations" / "evictions"
+
+    def enabled(self, site):
+        return site in self.sites and self.variants > 0 and self.max_bytes > 0
+
+    @staticmethod
+    def key(model, system_prompt, messages):
+        request = json.dumps([model, system_prompt, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT, site TEXT, created REAL, used REAL, size INTEGER, response TEXT
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_by_key ON responses (key)")
+        return conn
+
+    def lookup(self, site, system_prompt, messages, model=CLAUDE_MODEL):
+        """Return (key, reply): a random cached variant once the request's pool is full, else None.
+
+        The key is None when `site` isn't enabled; otherwise a None reply is a miss, and the reply
+        Claude gives should be put() under the key.
+        """
+        if not self.enabled(site):
+            return None, None
+        key = self.key(model, system_prompt, messages)
+        now = time.time()
+        with tracer.span("llm_cache", site=site) as span, closing(self.connect()) as conn, conn:
+            self.counters["expirations"] += conn.execute("DELETE FROM responses WHERE key = ? AND created < ?",
+                                                         (key, now - self.ttl)).rowcount
+            rows = conn.execute("SELECT rowid, response FROM responses WHERE key = ?", (key,)).fetchall()
+            if len(rows) < self.variants:
+                self.counters[site, "misses"] += 1
+                span.set(hit=False)
+                return key, None
+            rowid, reply = random.choice(rows)
+            conn.execute("UPDATE responses SET used = ? WHERE rowid = ?", (now, rowid))
+            self.counters[site, "hits"] += 1
+            span.set(hit=True)
+        print(f"{Style.DIM}(reusing a cached reply){Style.RESET_ALL}")
+        return key, reply
+
+    def put(self, key, site, reply):
+        """Add a reply to the key's pool, then evict the least recently used replies if over budget."""
+        size = len(reply.encode("utf-8"))
+        if not reply or size > self.max_bytes:
+            return
+        now = time.time()
+        with closing(self.connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another session may have filled the pool in the meantime
+            if conn.execute("SELECT COUNT(*) FROM responses WHERE key = ?", (key,)).fetchone()[0] >= self.variants:
+                return
+            conn.execute("INSERT INTO responses (key, site, created, used, size, response) VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, site, now, now, size, reply))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for rowid, entry_size in conn.execute("SELECT rowid, size FROM responses ORDER BY used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM responses WHERE rowid = ?", (rowid,))
+                total -= entry_size
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        """Return hit/miss counters overall and per call site."""
+        sites = {}
+        for site in sorted(self.sites):
+            hits, misses = self.counters[site, "hits"], self.counters[site, "misses"]
+            sites[site] = {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+        hits = sum(stats["hits"] for stats in sites.values())
+        lookups = hits + sum(stats["misses"] for stats in sites.values())
+        return {
+            "hits": hits,
+            "misses": lookups - hits,
+            "expirations": self.counters["expirations"],
+            "evictions": self.counters["evictions"],
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "sites": sites,
+        }
+
+# Off until call sites are enabled with --llm_cache
+llm_cache = ResponseCache(os.path.join(DEFAULT_CACHE_DIR, "llm.sqlite3"))
+
+@functools.lru_cache(maxsize=None)
+def available_tts_langs():
+    """Languages supported by gTTS, computed once per process."""
+    return gtts_lang.tts_langs()
+
+@functools.lru_cache(maxsize=None)
+def resolve_tts_lang(lang):
+    """Find the gTTS language code to use for a language, falling back to English."""
+    available_langs = available_tts_langs()
 
     # Try the exact language code first
     if lang in available_langs:
@@ -185,69 +1731,542 @@ def text_to_speech_google(text, lang):
     if tts_lang is None:
         print(f"No suitable language found for {lang}. Falling back to English.")
         tts_lang = 'en'
+    return tts_lang
+
+def synthesize_google_parts(text, lang):
+    """Synthesize text with Google TTS (gTTS), yielding mp3 segments as they arrive.
+
+    gTTS fetches long text in ~100-character chunks, so playback can start after the first one.
+    Previously synthesized phrases are served from the audio cache without a network round trip.
+    If Google TTS fails before anything was yielded, falls back to the macOS voices where available.
+    """
+    with tracer.span("tts", backend="gtts", chars=len(text)) as span:
+        tts_lang = resolve_tts_lang(lang)
+        audio = tts_cache.get(text, tts_lang, "gtts")
+        span.set(cache_hit=audio is not None)
+        if audio is not None:
+            yield from unpack_segments(audio)
+            return
+
+        parts = []
+        try:
+            # The language was already checked above, so skip gTTS's own (uncached) check
+            for part in service_clients.gtts_audio_parts(gtts.gTTS(text=text, lang=tts_lang, lang_check=False)):
+                parts.append(part)
+                yield part
+        except Exception as e:
+            if parts or shutil.which("say") is None:
+                raise
+            print(f"{Fore.YELLOW}Google TTS failed ({type(e).__name__}), using macOS speech instead.{Style.RESET_ALL}")
+            stage_calls["tts"].count("fallbacks")
+            span.set(backend="mac")
+            yield synthesize_mac(text, lang)
+            return
+        tts_cache.put(text, tts_lang, "gtts", pack_segments(parts))
+        span.set(bytes_downloaded=sum(len(part) for part in parts))
+
+def pack_segments(segments):
+    """Join audio segments into one blob that keeps their boundaries (each is prefixed with its length).
+
+    Concatenated mp3 segments don't decode as one file: the decoder trusts the first segment's
+    Xing header and stops after it, so stored audio keeps the segments apart.
+    """
+    return b"".join(len(segment).to_bytes(4, "big") + segment for segment in segments)
+
+def unpack_segments(data):
+    """Split a blob written by pack_segments() back into its segments."""
+    segments, offset = [], 0
+    while offset < len(data):
+        size = int.from_bytes(data[offset:offset + 4], "big")
+        segments.append(data[offset + 4:offset + 4 + size])
+        offset += 4 + size
+    return segments
+
+def decode_audio(data):
+    """Decode an encoded audio segment (mp3, aiff, wav...) to mono float32 samples and their rate."""
+    samples, sample_rate = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    return downmix(samples), sample_rate
+
+class StreamingPlayer:
+    """Plays encoded audio segments in-process, decoding each one as it arrives.
+
+    play() consumes an iterable of segments (e.g. straight from synthesize_google_parts), so the
+    first segment is heard while later ones are still downloading. stop() may be called from any
+    thread to barge in; audio is written in short chunks, so playback ends within one chunk.
+    Subclasses implement write(), finish() and abort() for a particular output.
+    """
+
+    CHUNK_SECONDS = 0.05
+
+    def __init__(self):
+        self.stopped = threading.Event()
+
+    def play(self, segments):
+        """Play segments back to back; returns once played, or early if stop() was called."""
+        self.stopped.clear()
+        played = 0.0
+        with tracer.span("playback", backend=type(self).__name__) as span:
+            try:
+                for segment in segments:
+                    if self.stopped.is_set():
+                        break
+                    samples, sample_rate = decode_audio(segment)
+                    chunk = max(1, int(self.CHUNK_SECONDS * sample_rate))
+                    for start in range(0, len(samples), chunk):
+                        if self.stopped.is_set():
+                            break
+                        self.write(samples[start:start + chunk], sample_rate)
+                        played += min(chunk, len(samples) - start) / sample_rate
+            finally:
+                if self.stopped.is_set():
+                    self.abort()
+                else:
+                    self.finish()
+                span.set(audio_seconds=played, interrupted=self.stopped.is_set())
+
+    def stop(self):
+        """Cut off the current playback (barge-in)."""
+        self.stopped.set()
+
+    def write(self, samples, sample_rate):
+        raise NotImplementedError
+
+    def finish(self):
+        """Wait for written audio to finish playing."""
+
+    def abort(self):
+        """Discard any audio that was written but not yet played."""
+
+    def close(self):
+        """Release the output when the program is done with it."""
+
+class SoundDevicePlayer(StreamingPlayer):
+    """Plays through the default output device with sounddevice (PortAudio), on macOS, Linux or Windows."""
+
+    def __init__(self):
+        super().__init__()
+        self.stream = None
+
+    def write(self, samples, sample_rate):
+        if self.stream is None:
+            self.stream = sd.OutputStream(samplerate=sample_rate, channels=1, dtype="float32", latency="low")
+            self.stream.start()
+        if sample_rate != self.stream.samplerate:
+            samples = resample(samples, sample_rate, int(self.stream.samplerate))
+        self.stream.write(np.ascontiguousarray(samples, dtype=np.float32).reshape(-1, 1))
+
+    def finish(self):
+        if self.stream is not None:
+            self.stream.stop()  # Returns once buffered audio has played
+            self.stream.close()
+            self.stream = None
+
+    def abort(self):
+        if self.stream is not None:
+            self.stream.abort()
+            self.stream.close()
+            self.stream = None
+
+class NullPlayer(StreamingPlayer):
+    """Discards audio, taking as long as it would take to play when `realtime` (for headless runs)."""
+
+    def __init__(self, realtime=True):
+        super().__init__()
+        self.realtime = realtime
+        self.seconds_played = 0.0
+        self.deadline = None
+
+    def write(self, samples, sample_rate):
+        duration = len(samples) / sample_rate
+        self.seconds_played += duration
+        if self.realtime:
+            now = time.perf_counter()
+            self.deadline = max(self.deadline or now, now) + duration
+            # Keep about one chunk "buffered", like a sound card would
+            self.stopped.wait(max(0.0, self.deadline - now - self.CHUNK_SECONDS))
+
+    def finish(self):
+        if self.deadline is not None:
+            self.stopped.wait(max(0.0, self.deadline - time.perf_counter()))
+        self.deadline = None
+
+    def abort(self):
+        self.deadline = None
+
+class FilePlayer(StreamingPlayer):
+    """Writes everything played to a WAV file instead of a device (for headless testing)."""
+
+    def __init__(self, path, realtime=False):
+        super().__init__()
+        self.path = path
+        self.file = None
+        self.pacer = NullPlayer(realtime)
+        self.pacer.stopped = self.stopped
+
+    def write(self, samples, sample_rate):
+        if self.file is None:
+            self.file = sf.SoundFile(self.path, mode="w", samplerate=sample_rate, channels=1)
+        if sample_rate != self.file.samplerate:
+            samples = resample(samples, sample_rate, self.file.samplerate)
+        self.file.write(samples)
+        self.pacer.write(samples, self.file.samplerate)
+
+    def finish(self):
+        self.pacer.finish()
+        if self.file is not None:
+            self.file.flush()
+
+    def abort(self):
+        self.pacer.abort()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class CommandPlayer:
+    """Plays each segment by running an external player (e.g. afplay) on a temporary file."""
+
+    def __init__(self, command=AUDIO_PLAYER):
+        self.command = command
+        self.stopped = threading.Event()
+        self.process = None
+
+    def play(self, segments):
+        self.stopped.clear()
+        with tracer.span("playback", backend="command"):
+            for segment in segments:
+                if self.stopped.is_set():
+                    break
+                suffix = ".aiff" if segment.startswith(b"FORM") else ".mp3"
+                with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_audio:
+                    temp_audio.write(segment)
+                try:
+                    self.process = subprocess.Popen([self.command, temp_audio.name])
+                    self.process.wait()
+                finally:
+                    self.process = None
+                    os.unlink(temp_audio.name)
+
+    def stop(self):
+        self.stopped.set()
+        process = self.process
+        if process is not None:
+            process.terminate()
+
+    def close(self):
+        pass
+
+def make_audio_output(player="sounddevice", path="playback.wav"):
+    """Create the playback backend: 'sounddevice', 'command' (AUDIO_PLAYER), 'null' or 'file'."""
+    if player == "sounddevice":
+        return SoundDevicePlayer()
+    if player == "command":
+        return CommandPlayer(AUDIO_PLAYER)
+    if player == "null":
+        return NullPlayer()
+    if player == "file":
+        return FilePlayer(path)
+    raise ValueError(f"Unknown audio player: {player}")
+
+audio_output = SoundDevicePlayer()
 
-    tts = gTTS(text=text, lang=tts_lang)
+def text_to_speech_google(text, lang):
+    """Convert text to speech using Google TTS (gTTS) with language fallbacks."""
+    print("Converting text to speech with Google TTS...")
+    audio_output.play(synthesize_google_parts(text, lang))
+
+class SpeechPipeline:
+    """Synthesize and play sentences in order on background threads.
+
+    Synthesis of the next sentence overlaps with playback of the current one, so the
+    first sentence can be heard while Claude is still writing the rest of the reply.
+    All sentences of a reply are played as one stream of segments by `output` (default: `audio_output`).
+    """
+
+    def __init__(self, lang, output=None):
+        self.lang = lang
+        self.output = output or audio_output
+        self.started = time.perf_counter()
+        self.first_audio_at = None
+        self.first_audio = threading.Event()
+        self.text_queue = queue.Queue()
+        self.audio_queue = queue.Queue()
+        self.cancelled = threading.Event()
+        # Run in the caller's context, so a server session's log and trace ids follow its audio
+        self.threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(loop,), daemon=True)
+            for loop in (self._synthesize_loop, self._playback_loop)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def say(self, text):
+        """Queue a sentence to be spoken after everything queued before it."""
+        self.text_queue.put(text)
+
+    def say_audio(self, audio):
+        """Queue already-synthesized audio to be played after everything queued before it."""
+        self.text_queue.put(bytes(audio))
+
+    def end(self):
+        """Mark that no more sentences will be queued."""
+        self.text_queue.put(None)
+
+    def wait(self):
+        """Wait until the pipeline has finished (or been cancelled)."""
+        for thread in self.threads:
+            thread.join()
+
+    def close(self):
+        """Wait until every queued sentence has been played."""
+        self.end()
+        self.wait()
+
+    def cancel(self):
+        """Drop anything not yet played, cut off the current sentence and stop the worker threads."""
+        self.cancelled.set()
+        self.text_queue.put(None)
+        self.audio_queue.put(None)
+        self.output.stop()
+
+    def _synthesize_loop(self):
+        while True:
+            text = self.text_queue.get()
+            if text is None or self.cancelled.is_set():
+                break
+            if isinstance(text, bytes):
+                self.audio_queue.put(text)
+                continue
+            try:
+                for segment in synthesize_google_parts(text, self.lang):
+                    if self.cancelled.is_set():
+                        break
+                    self.audio_queue.put(segment)
+            except Exception as e:
+                print(f"{Fore.RED}Error synthesizing speech: {e}{Style.RESET_ALL}")
+        self.audio_queue.put(None)
+
+    def _segments(self):
+        while not self.cancelled.is_set():
+            segment = self.audio_queue.get()
+            if segment is None:
+                break
+            if self.first_audio_at is None:
+                self.first_audio_at = time.perf_counter()
+                self.first_audio.set()
+            yield segment
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_audio:
-        tts.save(temp_audio.name)
-        temp_audio_path = temp_audio.name
+    def _playback_loop(self):
+        try:
+            self.output.play(self._segments())
+        except Exception as e:
+            print(f"{Fore.RED}Error playing speech: {e}{Style.RESET_ALL}")
+        finally:
+            self.first_audio.set()  # Also wakes waiters when there was nothing to play
 
-    subprocess.run(["afplay", temp_audio_path])
-    os.unlink(temp_audio_path)
+def print_first_audio_latency(seconds):
+    """Print how long the learner waited before hearing the reply."""
+    print(f"{Style.DIM}(first audio after {seconds:.2f}s){Style.RESET_ALL}")
 
 def text_to_speech_mac(text, lang, rate=200):
     """Variant: Convert text to speech using macOS 'say' command with voice fallbacks."""
     print("Converting text to speech with macOS...")
+    with tracer.span("tts", backend="mac", chars=len(text)):
+        audio = synthesize_mac(text, lang, rate)
+    # Played on audio_output, so it can be interrupted like any other reply
+    audio_output.play([audio])
+
+def synthesize_mac(text, lang, rate=200):
+    """Render text with the macOS 'say' command (trying each voice for the language) and return AIFF bytes."""
     voices = MAC_LANG_TO_VOICE.get(lang, ["Samantha"])  # Default to Samantha if language not found
+    fd, path = tempfile.mkstemp(suffix=".aiff")
+    os.close(fd)
+    try:
+        for voice in voices:
+            try:
+                subprocess.run(["say", "-v", voice, "-r", str(rate), "-o", path, text], check=True)
+                break  # If successful, exit the loop
+            except subprocess.CalledProcessError:
+                print(f"Voice '{voice}' not available. Trying next option.")
+        else:
+            print("No suitable voice found. Using default system voice.")
+            subprocess.run(["say", "-r", str(rate), "-o", path, text])
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+class ProgressStore:
+    """SQLite-backed history of a learner's progress records, one database per user folder.
+
+    Looking up the latest record is an index lookup instead of a directory scan, each write is
+    an atomic transaction, and history can be queried by language and time range. Progress
+    JSON files from older versions are imported the first time a folder is opened.
+    """
+
+    def __init__(self, user_folder):
+        self.user_folder = user_folder
+        self.path = os.path.join(user_folder, PROGRESS_DB)
+
+    def connect(self):
+        """Open the database, creating it (and importing legacy JSON files) if needed."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS progress (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {", ".join(f"{field} {'INTEGER' if field == 'current_level' else 'TEXT'}" for field in PROGRESS_FIELDS)}
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS progress_by_language ON progress (language, timestamp)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() is None:
+            self.import_json_files(conn)
+        return conn
+
+    def import_json_files(self, conn):
+        """One-shot migration of progress_*.json files into the database, oldest first."""
+        files = [f for f in os.listdir(self.user_folder) if PROGRESS_FILE_RE.match(f)]
+        files.sort(key=lambda f: os.path.getmtime(os.path.join(self.user_folder, f)))
+        records = []
+        for filename in files:
+            try:
+                with open(os.path.join(self.user_folder, filename), 'r') as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"{Fore.RED}Skipping unreadable progress file {filename}: {e}{Style.RESET_ALL}")
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another process may have finished the import while we were reading files
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() is None:
+                for record in records:
+                    self._insert(conn, record)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)", (str(len(records)),))
+        if records:
+            print(f"Imported {len(records)} progress files into {self.path}")
+        return len(records)
+
+    def _insert(self, conn, record):
+        conn.execute(
+            f"INSERT INTO progress ({', '.join(PROGRESS_FIELDS)}) VALUES ({', '.join('?' for _ in PROGRESS_FIELDS)})",
+            [record.get(field, "") for field in PROGRESS_FIELDS],
+        )
 
-    for voice in voices:
-        try:
-            subprocess.run(["say", "-v", voice, "-r", str(rate), text], check=True)
-            break  # If successful, exit the loop
-        except subprocess.CalledProcessError:
-            print(f"Voice '{voice}' not available. Trying next option.")
-    else:
-        print("No suitable voice found. Using default system voice.")
-        subprocess.run(["say", "-r", str(rate), text])
+    def latest(self, conn=None, language=None):
+        """Return the most recent progress record (optionally for one language name), or None."""
+        if conn is None:
+            with closing(self.connect()) as conn:
+                return self.latest(conn, language)
+        if language is None:
+            row = conn.execute("SELECT * FROM progress ORDER BY id DESC LIMIT 1").fetchone()
+        else:
+            row = conn.execute("SELECT * FROM progress WHERE language = ? ORDER BY id DESC LIMIT 1", (language,)).fetchone()
+        return self._as_record(row) if row else None
+
+    def latest_per_language(self):
+        """Return the most recent progress record of each language, keyed by language name."""
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT * FROM progress WHERE id IN (SELECT MAX(id) FROM progress GROUP BY language) ORDER BY language").fetchall()
+        return {row["language"]: self._as_record(row) for row in rows}
+
+    def append(self, record, merge_previous=()):
+        """Atomically add a record, filling empty `merge_previous` fields from the latest record."""
+        with closing(self.connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            previous = self.latest(conn) or {}
+            for field in merge_previous:
+                record[field] = record.get(field) or previous.get(field, "")
+            self._insert(conn, record)
+        return record
+
+    def revise(self, record, **fields):
+        """Atomically overwrite `fields` of `record` in place, if it is still the latest record of its language.
+
+        Returns the revised record, or None (writing nothing) if a newer record was added meanwhile.
+        """
+        with closing(self.connect()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM progress WHERE language = ? ORDER BY id DESC LIMIT 1", (record["language"],)).fetchone()
+            if row is None or self._as_record(row) != record:
+                return None
+            if fields:
+                conn.execute(f"UPDATE progress SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                             [*fields.values(), row["id"]])
+        return {**record, **fields}
+
+    def history(self, language=None, since=None, until=None):
+        """Return records oldest first, optionally filtered by language name and timestamp range."""
+        conditions, params = [], []
+        for clause, value in (("language = ?", language), ("timestamp >= ?", since), ("timestamp <= ?", until)):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with closing(self.connect()) as conn:
+            rows = conn.execute(f"SELECT * FROM progress {where} ORDER BY id", params).fetchall()
+        return [self._as_record(row) for row in rows]
+
+    def level_over_time(self, language):
+        """Return (timestamp, level) pairs for one language, oldest first."""
+        return [(record["timestamp"], record["current_level"]) for record in self.history(language)]
+
+    def lessons_per_language(self):
+        """Return the number of recorded sessions per language."""
+        with closing(self.connect()) as conn:
+            rows = conn.execute("SELECT language, COUNT(*) FROM progress GROUP BY language ORDER BY language").fetchall()
+        return {language: count for language, count in rows}
+
+    @staticmethod
+    def _as_record(row):
+        return {field: row[field] for field in PROGRESS_FIELDS}
 
 def read_latest_user_progress(user_folder):
-    """Read the most recent user progress file."""
+    """Read the most recent user progress record."""
     if not os.path.exists(user_folder):
         return None
-    files = [f for f in os.listdir(user_folder) if f.endswith('.json')]
-    if not files:
-        return None
-    latest_file = max(files, key=lambda f: os.path.getmtime(os.path.join(user_folder, f)))
-    with open(os.path.join(user_folder, latest_file), 'r') as f:
-        return json.load(f)
+    with tracer.span("progress_read"):
+        return ProgressStore(user_folder).latest()
 
 def write_user_progress(user_folder, lang, level, lesson_summary, overall_progress="", language_goals="", proximal_development=""):
-    """Write a new user progress file."""
+    """Write a new user progress record."""
     if not os.path.exists(user_folder):
         os.makedirs(user_folder)
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"progress_{timestamp}.json"
-
-    previous_progress = read_latest_user_progress(user_folder) or {}
-
     progress = {
-        "timestamp": timestamp,
+        "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
         "language": LANG_CODE_TO_NAME.get(lang, "Unknown language"),
         "current_level": level,
         "lesson_summary": lesson_summary,
-        "overall_progress": overall_progress or previous_progress.get("overall_progress", ""),
-        "language_goals": language_goals or previous_progress.get("language_goals", ""),
-        "proximal_development": proximal_development or previous_progress.get("proximal_development", "")
+        "overall_progress": overall_progress,
+        "language_goals": language_goals,
+        "proximal_development": proximal_development
     }
-
-    with open(os.path.join(user_folder, filename), 'w') as f:
-        json.dump(progress, f, indent=2)
-
-def update_progress_with_claude(user_folder, lang, level, lesson_summary):
-    """Use Claude 3.5 Sonnet to update the user's overall progress and language goals."""
-    previous_progress = read_latest_user_progress(user_folder) or {}
-
+    with tracer.span("progress_write"):
+        return ProgressStore(user_folder).append(progress, merge_previous=("overall_progress", "language_goals", "proximal_development"))
+
+def revise_user_progress(user_folder, record, overall_progress="", language_goals="", proximal_development=""):
+    """Replace the progress sections of an existing record, if it is still the latest of its language.
+
+    Empty sections keep their old text. Returns the revised record, or None if the learner has
+    recorded a newer session since. The record keeps its timestamp, level and lesson summary,
+    so the history still has exactly one record per session.
+    """
+    sections = {"overall_progress": overall_progress, "language_goals": language_goals, "proximal_development": proximal_development}
+    with tracer.span("progress_write"):
+        return ProgressStore(user_folder).revise(record, **{field: text for field, text in sections.items() if text})
+
+def migrate_progress_folders(root):
+    """Import the progress JSON files of every user folder under `root` into their progress databases."""
+    migrated = 0
+    for entry in sorted(os.scandir(root), key=lambda entry: entry.name):
+        if entry.is_dir() and any(PROGRESS_FILE_RE.match(name) for name in os.listdir(entry.path)):
+            with closing(ProgressStore(entry.path).connect()):
+                migrated += 1
+    print(f"Checked {migrated} user folders under {root}")
+
+def progress_update_params(previous_progress, lang, level, lesson_summary):
+    """Message parameters asking Claude for an updated progress report, for live sessions and batch recomputes alike."""
     system_prompt = """You are an AI language learning assistant. Your task is to provide a detailed update on the user's overall progress and language goals based on their previous progress and recent lesson summary. Focus on the user's proximal zone of development to inform future lessons efficiently."""
 
     user_message = f"""Based on the user's previous progress and the recent lesson summary, provide an updated overall progress and language goals for the user. Focus on the proximal zone of development to suggest the most efficient ways to improve.
@@ -273,19 +2292,18 @@ A few paragraphs outlining specific language goals tailored to the user's curren
 A paragraph discussing the user's proximal zone of development and recommendations for future lessons to maximize learning efficiency.
 </proximal_development>"""
 
-    response = anthropic_client.messages.create(
+    return dict(
         model="claude-3-5-sonnet-20240620",
         max_tokens=1000,
         temperature=0.7,
         system=system_prompt,
         messages=[
             {"role": "user", "content": user_message},
-        ]
+        ],
     )
 
-    claude_response = response.content[0].text
-
-    # Parse the XML response
+def parse_progress_update(claude_response):
+    """Extract the <overall_progress>, <language_goals> and <proximal_development> sections of Claude's reply."""
     overall_progress = re.search(r'<overall_progress>(.*?)</overall_progress>', claude_response, re.DOTALL)
     language_goals = re.search(r'<language_goals>(.*?)</language_goals>', claude_response, re.DOTALL)
     proximal_development = re.search(r'<proximal_development>(.*?)</proximal_development>', claude_response, re.DOTALL)
@@ -296,57 +2314,304 @@ A paragraph discussing the user's proximal zone of development and recommendatio
 
     return overall_progress, language_goals, proximal_development
 
-def diagnostic_test(lang, user_folder):
+def update_progress_with_claude(user_folder, lang, level, lesson_summary, previous_progress=None):
+    """Use Claude 3.5 Sonnet to update the user's overall progress and language goals.
+
+    `previous_progress` defaults to the user's latest progress record.
+    """
+    if previous_progress is None:
+        previous_progress = read_latest_user_progress(user_folder) or {}
+    params = progress_update_params(previous_progress, lang, level, lesson_summary)
+
+    with tracer.span("llm", stream=False, call_site="progress") as span:
+        response = stage_calls["llm"].call(lambda timeout: service_clients.anthropic.messages.create(**params, timeout=timeout))
+        record_usage(span, response.usage)
+
+    return parse_progress_update(response.content[0].text)
+
+class ProgressRecompute:
+    """Re-evaluates the latest progress of every learner and language under a directory of user folders.
+
+    Each learner's latest record per language goes back through the progress prompt, either as
+    Message Batches (half price, results within a day) or through a bounded pool of concurrent
+    requests, and the new sections replace the old ones in that same record (revise_user_progress),
+    so no session is counted twice in the learner's history. The job is checkpointed
+    next to the user folders, so an interrupted run resumes where it stopped, collecting batches
+    it already submitted instead of paying for them twice. Records that changed after the job
+    started (say, the learner finished another lesson) are left alone.
+    """
+
+    def __init__(self, root, checkpoint_path=None):
+        self.root = root
+        self.checkpoint_path = checkpoint_path or os.path.join(root, RECOMPUTE_CHECKPOINT)
+        self.outcomes = defaultdict(int)
+        self.unsaved = 0
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.job = json.load(f)
+            print(f"Resuming the progress recompute started {self.job['started']} "
+                  f"({len(self.job['done'])} of {len(self.job['items'])} records done)")
+        else:
+            self.job = {"started": datetime.now().strftime("%Y%m%d_%H%M%S"), "items": self.scan(), "batches": [], "done": {}}
+            self.save()
+            print(f"Found {len(self.job['items'])} progress records to recompute under {root}")
+
+    def scan(self):
+        """Collect the latest record of each language in every user folder, keyed by a batch-safe custom_id."""
+        codes = {name: code for code, name in LANG_CODE_TO_NAME.items()}
+        items = {}
+        for entry in sorted(os.scandir(self.root), key=lambda entry: entry.name):
+            if not entry.is_dir():
+                continue
+            names = os.listdir(entry.path)
+            if PROGRESS_DB not in names and not any(PROGRESS_FILE_RE.match(name) for name in names):
+                continue
+            for language, record in ProgressStore(entry.path).latest_per_language().items():
+                if language in codes and record["lesson_summary"]:
+                    items[f"progress-{len(items):06d}"] = {"user_folder": entry.path, "lang": codes[language], "record": record}
+        return items
+
+    def save(self):
+        write_atomically(self.checkpoint_path, json.dumps(self.job).encode())
+        self.unsaved = 0
+
+    def pending(self):
+        return [custom_id for custom_id in self.job["items"] if custom_id not in self.job["done"]]
+
+    def is_current(self, item):
+        """Whether the record an item was built from is still the latest of its language."""
+        return ProgressStore(item["user_folder"]).latest(language=item["record"]["language"]) == item["record"]
+
+    def write(self, item, sections):
+        """Write recomputed sections into the source record, unless the learner's progress changed meanwhile."""
+        if not any(sections):
+            return "failed"  # Claude's reply had none of the tags
+        revised = revise_user_progress(item["user_folder"], item["record"], *sections)
+        return "written" if revised else "changed"
+
+    def mark(self, custom_id, outcome):
+        """Count an item's outcome; written and changed items are done, failed ones are retried by the next run."""
+        self.outcomes[outcome] += 1
+        if outcome == "failed":
+            return
+        self.job["done"][custom_id] = outcome
+        self.unsaved += 1
+        if self.unsaved >= CHECKPOINT_EVERY:
+            self.save()
+
+    def run(self, mode="batch", concurrency=8, poll_seconds=30.0):
+        """Recompute every pending record, then report and (once nothing is left) remove the checkpoint."""
+        try:
+            # Batches submitted by an earlier run are collected whatever the mode
+            if mode == "batch" or self.job["batches"]:
+                try:
+                    self.run_batches(poll_seconds)
+                except (anthropic.NotFoundError, anthropic.PermissionDeniedError) as e:
+                    if self.job["batches"]:
+                        raise
+                    print(f"{Fore.YELLOW}Message Batches are unavailable ({e.status_code}); "
+                          f"sending the requests concurrently instead.{Style.RESET_ALL}")
+                    mode = "pool"
+            if mode == "pool":
+                resize_service_pools(concurrency)
+                asyncio.run(self.run_pool(concurrency))
+        finally:
+            self.save()
+
+        print(f"Recomputed {self.outcomes['written']} progress records; {self.outcomes['changed']} left alone because "
+              f"the learner's progress changed since, {self.outcomes['failed']} failed.")
+        remaining = len(self.pending())
+        if remaining:
+            print(f"{Fore.YELLOW}{remaining} records are not done yet; run the same command again to retry them.{Style.RESET_ALL}")
+        else:
+            os.remove(self.checkpoint_path)
+
+    def run_batches(self, poll_seconds):
+        if not self.job["batches"]:
+            self.submit_batches()
+        while self.job["batches"]:
+            self.collect_batch(self.job["batches"][0], poll_seconds)
+            self.job["batches"].pop(0)
+            self.save()
+
+    def submit_batches(self):
+        """Submit every pending, still-current record as Message Batches and checkpoint their ids."""
+        pending = []
+        for custom_id in self.pending():
+            if self.is_current(self.job["items"][custom_id]):
+                pending.append(custom_id)
+            else:
+                self.mark(custom_id, "changed")
+        for start in range(0, len(pending), BATCH_MAX_REQUESTS):
+            batch_requests = []
+            for custom_id in pending[start:start + BATCH_MAX_REQUESTS]:
+                record, lang = self.job["items"][custom_id]["record"], self.job["items"][custom_id]["lang"]
+                params = progress_update_params(record, lang, record["current_level"], record["lesson_summary"])
+                batch_requests.append({"custom_id": custom_id, "params": params})
+            # The SDK version we pin predates its batches resource, so the endpoints are called directly
+            batch = stage_calls["llm"].call(lambda timeout: service_clients.anthropic.post(
+                "/v1/messages/batches", body={"requests": batch_requests}, cast_to=object, options={"timeout": timeout}))
+            self.job["batches"].append(batch["id"])
+            self.save()
+            print(f"Submitted batch {batch['id']} with {len(batch_requests)} requests")
+
+    def collect_batch(self, batch_id, poll_seconds):
+        """Wait for a batch to end, then write each of its results."""
+        while True:
+            batch = stage_calls["llm"].call(lambda timeout: service_clients.anthropic.get(
+                f"/v1/messages/batches/{batch_id}", cast_to=object, options={"timeout": timeout}))
+            if batch["processing_status"] == "ended":
+                break
+            counts = batch["request_counts"]
+            print(f"{Style.DIM}Batch {batch_id}: {counts['processing']} processing, {counts['succeeded']} succeeded, "
+                  f"{counts['errored']} errored{Style.RESET_ALL}")
+            time.sleep(poll_seconds)
+
+        results = stage_calls["llm"].call(lambda timeout: service_clients.anthropic.get(
+            f"/v1/messages/batches/{batch_id}/results", cast_to=str, options={"timeout": timeout}))
+        for line in results.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            custom_id = result["custom_id"]
+            if custom_id not in self.job["items"] or custom_id in self.job["done"]:
+                continue
+            if result["result"]["type"] != "succeeded":
+                self.mark(custom_id, "failed")  # errored, canceled or expired
+                continue
+            text = "".join(block.get("text", "") for block in result["result"]["message"]["content"])
+            self.mark(custom_id, self.write(self.job["items"][custom_id], parse_progress_update(text)))
+
+    async def run_pool(self, concurrency):
+        """Send the pending records' requests directly, `concurrency` at a time."""
+        asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=concurrency))
+        slots = asyncio.Semaphore(concurrency)
+
+        async def recompute(custom_id):
+            async with slots:
+                outcome = await asyncio.to_thread(self.recompute_one, self.job["items"][custom_id])
+            self.mark(custom_id, outcome)
+
+        await asyncio.gather(*(recompute(custom_id) for custom_id in self.pending()))
+
+    def recompute_one(self, item):
+        if not self.is_current(item):
+            return "changed"
+        record = item["record"]
+        try:
+            sections = update_progress_with_claude(item["user_folder"], item["lang"], record["current_level"],
+                                                   record["lesson_summary"], previous_progress=record)
+        except (anthropic.APIError, DeadlineExceeded) as e:
+            print(f"{Fore.RED}Couldn't recompute {item['user_folder']} ({record['language']}): {e}{Style.RESET_ALL}")
+            return "failed"
+        return self.write(item, sections)
+
+def diagnostic_test(lang, user_folder, options=None):
     """Conduct a diagnostic test to determine language proficiency."""
+    return asyncio.run(diagnostic_test_async(lang, user_folder, options))
+
+async def diagnostic_test_async(lang, user_folder, options=None, engine=None):
+    """asyncio implementation of diagnostic_test; the progress update overlaps the evaluator's last reply.
+
+    `engine` replaces the local SessionEngine, e.g. with a RemoteSession in server mode.
+    """
     system_prompt = f"""You are a language proficiency evaluator for {LANG_CODE_TO_NAME.get(lang, 'Unknown language')}.
     Conduct a verbal diagnostic test with 3 questions of increasing difficulty to assess the user's proficiency.
     After the test, provide a summary and assign a proficiency level from 1 to 10, where 1 is beginner and 10 is native-like fluency.
     Speak in the target language, but provide translations for beginners if they struggle."""
 
-    messages = [
-        {
-            "role": "user",
-            "content": f"Please start the {LANG_CODE_TO_NAME.get(lang, 'Unknown language')} proficiency test.",
-        },
-    ]
-
-    response = query_claude(messages, system_prompt)
-    text_to_speech_google(response, lang)
-    print("Evaluator:", response)
+    options = options or SessionOptions()
+    conversation = Conversation(
+        system_prompt,
+        f"Please start the {LANG_CODE_TO_NAME.get(lang, 'Unknown language')} proficiency test.",
+        options.context_budget,
+        prompt_cache=options.prompt_cache,
+        cache_site="diagnostic",
+    )
 
-    messages.append({"role": "assistant", "content": response})
+    async with engine or SessionEngine(lang, options) as engine:
+        response = await engine.tutor_turn(conversation, "Evaluator:")
 
-    for _ in range(7):  # Ask up to 7 questions
-        input("Press enter to record your answer.")
-        filename = record_speech()
-        user_response = speech_to_text(filename, lang)
-        print("You said:", user_response)
-        messages.append({"role": "user", "content": user_response})
+        for _ in range(7):  # Ask up to 7 questions
+            user_response = await engine.listen("Press enter to record your answer.")
+            print("You said:", user_response)
+            conversation.add("user", user_response)
 
-        response = query_claude(messages, system_prompt)
-        text_to_speech_google(response, lang)
-        print("Evaluator:", response)
+            response = await engine.tutor_turn(conversation, "Evaluator:")
 
-        messages.append({"role": "assistant", "content": response})
+            if "proficiency level" in response.lower():
+                break
 
-        if "proficiency level" in response.lower():
-            break
+        conversation.print_summary()
 
-    level = int(response.split("proficiency level")[-1].strip().split()[0])
+        level = int(response.split("proficiency level")[-1].strip().split()[0])
 
-    lesson_summary = f"Diagnostic test completed. Assigned proficiency level: {level}/10"
-    overall_progress, language_goals, proximal_development = update_progress_with_claude(user_folder, lang, level, lesson_summary)
-    write_user_progress(user_folder, lang, level, lesson_summary, overall_progress, language_goals, proximal_development)
+        lesson_summary = f"Diagnostic test completed. Assigned proficiency level: {level}/10"
+        await asyncio.gather(
+            asyncio.to_thread(save_progress, user_folder, lang, level, lesson_summary, options.prefetch),
+            engine.finish_playback(),
+        )
 
     return level
 
-def generate_lesson(lang, level, user_folder):
+def generate_lesson(lang, level, user_folder, options=None):
     """Generate a custom interactive lesson based on the given level."""
+    return asyncio.run(generate_lesson_async(lang, level, user_folder, options))
+
+async def generate_lesson_async(lang, level, user_folder, options=None, engine=None):
+    """asyncio implementation of generate_lesson.
+
+    Progress is loaded while the topic is generated, the learner can start answering during
+    the tail of playback, and the progress update runs while the closing reply is spoken.
+    `engine` replaces the local SessionEngine, e.g. with a RemoteSession in server mode.
+    """
+    options = options or SessionOptions()
+    async with engine or SessionEngine(lang, options) as engine:
+        prepared = await asyncio.to_thread(take_next_lesson, user_folder, lang, level) if options.prefetch else None
+        if prepared is not None:
+            print(f"{Fore.CYAN}Starting the lesson prepared after your last session: {prepared['topic']}{Style.RESET_ALL}")
+            topic, user_progress = prepared["topic"], prepared["user_progress"]
+        else:
+            topic, user_progress = await asyncio.gather(
+                asyncio.to_thread(generate_topic, lang, level),
+                asyncio.to_thread(read_latest_user_progress, user_folder),
+            )
+        conversation = lesson_conversation(lang, level, topic, user_progress, options.context_budget, options.prompt_cache)
+
+        await engine.tutor_turn(conversation, f"\n{Fore.CYAN}Turn 1 - Tutor:{Style.RESET_ALL}",
+                                (prepared["opening"], prepared["audio"]) if prepared is not None else None)
+
+        async def turns():
+            for turn in range(2, 50):
+                user_response = await engine.listen(f"\n{Fore.GREEN}Press enter to record your response (or Ctrl+C to finish early):{Style.RESET_ALL}")
+                print(f"\n{Fore.YELLOW}You said:{Style.RESET_ALL}", user_response)
+                conversation.add("user", user_response)
+
+                response = await engine.tutor_turn(conversation, f"\n{Fore.CYAN}Turn {turn} - Tutor:{Style.RESET_ALL}")
+
+                if "lesson is complete" in response.lower():
+                    break
+
+        if not await engine.run_turns(turns()):
+            print(f"\n{Fore.RED}Lesson terminated early by user.{Style.RESET_ALL}")
+        conversation.print_summary()
+
+        print(f"\n{Fore.CYAN}Writing lesson summary and updating progress...{Style.RESET_ALL}")
+        lesson_summary = f"Completed a level {level} lesson on the topic of {topic}"
+        await asyncio.gather(
+            asyncio.to_thread(save_progress, user_folder, lang, level, lesson_summary, options.prefetch),
+            engine.finish_playback(),
+        )
+
+    return level
+
+def generate_topic(lang, level):
+    """Ask Claude for a lesson topic inspired by two random words."""
     print(f"{Fore.CYAN}Generating a topic for the lesson...{Style.RESET_ALL}")
 
     # Select two random words
-    random_word1 = get_random_word()
-    random_word2 = get_random_word()
+    random_word1 = get_random_word(lang)
+    random_word2 = get_random_word(lang)
 
     print(f"{Fore.YELLOW}Inspiration words: {random_word1}, {random_word2}{Style.RESET_ALL}")
 
@@ -363,7 +2628,8 @@ def generate_lesson(lang, level, user_folder):
 
     At the end of your response, please clearly state the final topic by prefixing it with "FINAL TOPIC:"."""
 
-    topic_response = query_claude([{"role": "user", "content": topic_generation_prompt}], "You are a creative topic generator for language learning lessons.")
+    topic_response = query_claude([{"role": "user", "content": topic_generation_prompt}], "You are a creative topic generator for language learning lessons.",
+                                  cache_site="topic")
 
     print(f"{Fore.GREEN}Topic generation process:{Style.RESET_ALL}")
     print(topic_response)
@@ -377,7 +2643,10 @@ def generate_lesson(lang, level, user_folder):
         topic = "Daily routines"
 
     print(f"\n{Fore.GREEN}Selected topic: {topic}{Style.RESET_ALL}")
+    return topic
 
+def lesson_system_prompt(lang, level, topic, user_progress):
+    """Build the tutor's system prompt for a lesson, including the learner's latest progress."""
     system_prompt = f"""You are a concise language tutor for {LANG_CODE_TO_NAME.get(lang, 'Unknown language')} at proficiency level {level}/10.
     Create an interactive spoken-language lesson on the topic of {topic}. Possible activities include:
     1. Key vocabulary words or phrases
@@ -395,98 +2664,626 @@ def generate_lesson(lang, level, user_folder):
     
     Be highly interactive and encourage student output. Focus on sentence structure, grammar, and vocabulary rather than minor pronunciation or punctuation issues. If a user can't get the pronunciation right after 1-2 tries, just move on. (Also take into account that the student's response is being transcribed by a good but imperfect STT system) Don't use asterisks in your responses."""
 
-    user_progress = read_latest_user_progress(user_folder)
     if user_progress:
         system_prompt += f"\nUser's overall progress: {user_progress.get('overall_progress', 'Not available')}"
         system_prompt += f"\nUser's language goals: {user_progress.get('language_goals', 'Not available')}"
         system_prompt += f"\nUser's proximal zone of development: {user_progress.get('proximal_development', 'Not available')}"
+    return system_prompt
+
+def lesson_conversation(lang, level, topic, user_progress, context_budget=8000, prompt_cache=True):
+    """Start the conversation of a lesson on `topic`, before the tutor's opening reply."""
+    return Conversation(
+        lesson_system_prompt(lang, level, topic, user_progress),
+        f"Please start a {LANG_CODE_TO_NAME.get(lang, 'Unknown language')} lesson at level {level} on the topic of {topic}.",
+        context_budget,
+        prompt_cache=prompt_cache,
+    )
 
-    messages = [
-        {
-            "role": "user",
-            "content": f"Please start a {LANG_CODE_TO_NAME.get(lang, 'Unknown language')} lesson at level {level} on the topic of {topic}.",
-        },
-    ]
-
-    response = query_claude(messages, system_prompt)
-    print(f"\n{Fore.CYAN}Turn 1 - Tutor:{Style.RESET_ALL}")
-    print_colored_response(response)
+def save_progress(user_folder, lang, level, lesson_summary, prefetch=False):
+    """Have Claude update the learner's progress after a session and write it to their folder.
 
-    spoken_text = re.sub(r'\[.*?\]', '', response)  # Remove text in square brackets
-    text_to_speech_google(spoken_text.strip(), lang)
+    With `prefetch`, the next lesson at `level` is then prepared from the updated progress.
+    """
+    overall_progress, language_goals, proximal_development = update_progress_with_claude(user_folder, lang, level, lesson_summary)
+    write_user_progress(user_folder, lang, level, lesson_summary, overall_progress, language_goals, proximal_development)
+    if prefetch:
+        prepare_next_lesson(user_folder, lang, level)
+
+def progress_fingerprint(lang, level, user_progress):
+    """Hash of everything a prepared lesson depends on; it changes when the level or progress does."""
+    key = json.dumps([lang, int(level), user_progress], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def write_atomically(path, data):
+    """Write bytes to `path` through a temporary file, so readers never see a partial file."""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", suffix=".tmp", delete=False) as temp_file:
+        temp_file.write(data)
+    os.replace(temp_file.name, path)
+
+def prepare_next_lesson(user_folder, lang, level):
+    """Generate the next lesson's topic, opening reply and audio, and store them in the user folder.
+
+    take_next_lesson() hands them to the next session at the same level, if progress hasn't changed since.
+    """
+    print(f"\n{Fore.CYAN}Preparing your next lesson...{Style.RESET_ALL}")
+    path = os.path.join(user_folder, NEXT_LESSON_FILE.format(lang=lang))
+    try:
+        with tracer.span("prefetch", lang=lang, level=level) as span:
+            user_progress = read_latest_user_progress(user_folder)
+            topic = generate_topic(lang, level)
+            conversation = lesson_conversation(lang, level, topic, user_progress, prompt_cache=False)
+            opening = conversation.query()
+            spoken_text = strip_annotations(opening)
+            # Segments are kept apart: joined mp3 segments only decode up to the first one
+            audio = pack_segments(synthesize_google_parts(spoken_text, lang) if spoken_text else [])
+            span.set(audio_bytes=len(audio))
+
+            # Audio first, so the JSON never points at missing or partial audio
+            write_atomically(path + ".audio", audio)
+            bundle = {
+                "lang": lang,
+                "level": int(level),
+                "fingerprint": progress_fingerprint(lang, level, user_progress),
+                "topic": topic,
+                "opening": opening,
+                "audio_sha256": hashlib.sha256(audio).hexdigest(),
+                "created": datetime.now().isoformat(timespec="seconds"),
+            }
+            write_atomically(path + ".json", json.dumps(bundle, indent=2).encode())
+    except Exception as e:
+        print(f"{Fore.RED}Couldn't prepare the next lesson: {e}{Style.RESET_ALL}")
 
-    messages.append({"role": "assistant", "content": response})
+def take_next_lesson(user_folder, lang, level):
+    """Return the lesson prepared by prepare_next_lesson() if it is still valid, else None.
 
+    A prepared lesson is used at most once: it is removed whether or not it was still valid.
+    The result has the topic, opening reply, its mp3 segments and the progress it was based on.
+    """
+    path = os.path.join(user_folder, NEXT_LESSON_FILE.format(lang=lang))
     try:
-        for turn in range(2, 50):
-            input(f"\n{Fore.GREEN}Press enter to record your response (or Ctrl+C to finish early):{Style.RESET_ALL}")
-            filename = record_speech()
-            user_response = speech_to_text(filename, lang)
-            print(f"\n{Fore.YELLOW}You said:{Style.RESET_ALL}", user_response)
-            messages.append({"role": "user", "content": user_response})
-
-            response = query_claude(messages, system_prompt)
-            print(f"\n{Fore.CYAN}Turn {turn} - Tutor:{Style.RESET_ALL}")
-            print_colored_response(response)
+        with open(path + ".json") as f:
+            bundle = json.load(f)
+        with open(path + ".audio", "rb") as f:
+            audio = f.read()
+    except (OSError, ValueError):
+        return None
+    finally:
+        for suffix in (".json", ".audio"):
+            with suppress(OSError):
+                os.unlink(path + suffix)
 
-            # Improved bracket handling
-            spoken_text = re.sub(r'\s*\[.*?\]\s*', ' ', response)  # Remove brackets and their content, handling whitespace
-            spoken_text = re.sub(r'\s+', ' ', spoken_text)  # Clean up any double spaces
-            spoken_text = spoken_text.strip()  # Remove leading/trailing whitespace
-            
-            # Only speak if there's actual content after removing brackets
-            if spoken_text:
-                text_to_speech_google(spoken_text, lang)
+    user_progress = read_latest_user_progress(user_folder)
+    if (bundle.get("level") != int(level)
+            or bundle.get("fingerprint") != progress_fingerprint(lang, level, user_progress)
+            or bundle.get("audio_sha256") != hashlib.sha256(audio).hexdigest()):
+        print(f"{Style.DIM}(prepared lesson is out of date; generating a new one){Style.RESET_ALL}")
+        return None
+    return {**bundle, "audio": unpack_segments(audio), "user_progress": user_progress}
+
+def listen(lang, options, stop=None):
+    """Record the learner's answer and transcribe it.
+
+    Recording ends on Ctrl+C, when `stop` (a threading.Event) is set, or after a pause if options.auto_stop is on.
+    """
+    # A long pause between turns can outlast the keep-alive; reconnect while the learner speaks
+    service_clients.warm_up_if_idle()
+    endpointer = SpeechEndpointer(options.silence_hangover) if options.auto_stop else None
+    if options.stt == "live":
+        return record_and_transcribe_live(lang, options.audio_format, stop, endpointer=endpointer)
+    if options.capture == "memory":
+        audio = record_speech_to_memory(options.audio_format, stop, endpointer)
+    else:
+        audio = record_speech(stop, endpointer)
+    return speech_to_text(audio, lang)
 
-            messages.append({"role": "assistant", "content": response})
+def stream_tutor_turn(text_stream, lang, label, pipeline):
+    """Print a streamed reply and queue each sentence on `pipeline` as soon as Claude finishes writing it.
 
-            if "lesson is complete" in response.lower():
-                break
+    Returns once the reply is complete; the pipeline may still be speaking it.
+    """
+    chunks = []
+    buffer = ""
+    in_brackets = False
+    try:
+        for text in text_stream:
+            if not chunks:
+                print(label)
+            chunks.append(text)
+            in_brackets = print_colored_chunk(text, in_brackets)
+
+            sentences, buffer = split_sentences(buffer + text)
+            for sentence in sentences:
+                spoken_text = strip_annotations(sentence)
+                if spoken_text:
+                    pipeline.say(spoken_text)
+        print()  # New line at the end
+
+        spoken_text = strip_annotations(buffer)
+        if spoken_text:
+            pipeline.say(spoken_text)
+    except BaseException:
+        pipeline.cancel()
+        raise
+
+    if pipeline.first_audio_at is not None:
+        print_first_audio_latency(pipeline.first_audio_at - pipeline.started)
+    return "".join(chunks)
+
+async def ainput(prompt=""):
+    """input() that doesn't block the event loop.
+
+    Reads stdin one byte at a time as it becomes readable, so an abandoned prompt leaves no
+    blocked thread behind and typed-ahead lines stay in the pipe for the next prompt. Stdin
+    that can't be watched that way (e.g. redirected from a file) is read with input() on a thread.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        fd = sys.stdin.fileno()
+        mode = os.fstat(fd).st_mode
+        watchable = os.isatty(fd) or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+    except (OSError, ValueError):
+        watchable = False
+    if not watchable:
+        return await asyncio.to_thread(input, prompt)
+
+    print(prompt, end="", flush=True)
+    line = bytearray()
+    done = loop.create_future()
+
+    def on_readable():
+        char = os.read(fd, 1)
+        if char in (b"", b"\n") and not done.done():
+            done.set_result(char == b"\n" or bool(line))
+        else:
+            line.extend(char)
 
-    except KeyboardInterrupt:
-        print(f"\n{Fore.RED}Lesson terminated early by user.{Style.RESET_ALL}")
+    try:
+        loop.add_reader(fd, on_readable)
+    except (OSError, NotImplementedError):
+        return await asyncio.to_thread(input)  # The prompt is already printed
+    try:
+        if not await done:
+            raise EOFError("EOF when reading a line")
+    finally:
+        loop.remove_reader(fd)
+    return line.decode(errors="replace")
+
+class SessionEngine:
+    """Runs the turns of a lesson or diagnostic test as overlapping asyncio stages.
+
+    STT, Claude and TTS synthesis run in worker threads and replies play in the background on
+    `output` (default: `audio_output`), so the learner can start answering (and cut the reply off)
+    while it plays. While the engine is entered, Ctrl+C stops an in-progress recording, ends the
+    turns started by run_turns, or otherwise raises KeyboardInterrupt as usual.
+    """
+
+    handle_signals = True
+
+    def __init__(self, lang, options, output=None):
+        self.lang = lang
+        self.options = options
+        self.output = output
+        self.recording_stop = None  # threading.Event while the learner is being recorded
+        self.turns_task = None
+        self.playback = None
+        self.compaction = None
+
+    async def __aenter__(self):
+        if self.handle_signals:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.interrupt)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.handle_signals:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGINT)
+        await self.stop_playback()
+
+    def interrupt(self):
+        """Handle Ctrl+C: stop the recording if the learner is speaking, otherwise end the turns."""
+        if self.recording_stop is not None and not self.recording_stop.is_set():
+            self.recording_stop.set()
+        elif self.turns_task is not None and not self.turns_task.done():
+            self.turns_task.cancel()
+        else:
+            raise KeyboardInterrupt
 
-    print(f"\n{Fore.CYAN}Writing lesson summary and updating progress...{Style.RESET_ALL}")
-    lesson_summary = f"Completed a level {level} lesson on the topic of {topic}"
-    overall_progress, language_goals, proximal_development = update_progress_with_claude(user_folder, lang, level, lesson_summary)
-    write_user_progress(user_folder, lang, level, lesson_summary, overall_progress, language_goals, proximal_development)
+    async def run_turns(self, turns):
+        """Run the turn loop coroutine, returning False if the learner ended it early."""
+        self.turns_task = asyncio.ensure_future(turns)
+        try:
+            await self.turns_task
+        except asyncio.CancelledError:
+            if not self.turns_task.cancelled():
+                raise  # We were cancelled ourselves, not by interrupt()
+        return not self.turns_task.cancelled()
+
+    async def tutor_turn(self, conversation, label, prepared=None):
+        """Get, print and start speaking the next reply, without waiting for playback to finish.
+
+        The reply is added to the conversation. If the conversation has outgrown its token
+        budget, it is compacted in the background while the learner answers. `prepared` is an
+        already generated (reply, mp3 segments) pair to use instead of asking Claude.
+        """
+        if self.compaction is not None:
+            try:
+                await self.compaction
+            except Exception as e:
+                # The full history still works, it just costs more; compaction is retried after the next reply
+                print(f"{Fore.YELLOW}Couldn't summarize older messages ({type(e).__name__}), keeping them.{Style.RESET_ALL}")
+            finally:
+                self.compaction = None
+
+        response = await self._reply(conversation, label, prepared)
+        conversation.add("assistant", response)
+        conversation.print_turn_stats()
+
+        if conversation.needs_compaction():
+            self.compaction = asyncio.create_task(asyncio.to_thread(conversation.compact))
+        return response
+
+    async def _reply(self, conversation, label, prepared=None):
+        await self.stop_playback()
+        pipeline = SpeechPipeline(self.lang, self.output)
+        self.playback = asyncio.create_task(self._play(pipeline))
+        try:
+            if prepared is not None:
+                response, audio = prepared
+                print(label)
+                print_colored_response(response)
+                for segment in audio:
+                    pipeline.say_audio(segment)
+                return response
+            if self.options.stream:
+                return await asyncio.to_thread(stream_tutor_turn, conversation.stream(), self.lang, label, pipeline)
+
+            response = await asyncio.to_thread(conversation.query)
+            print(label)
+            print_colored_response(response)
 
-    return level
+            # Only speak if there's actual content after removing brackets
+            spoken_text = strip_annotations(response)
+            if spoken_text:
+                print("Converting text to speech with Google TTS...")
+                pipeline.say(spoken_text)
+                pipeline.end()
+                await asyncio.to_thread(pipeline.first_audio.wait)
+                if pipeline.first_audio_at is not None:
+                    print_first_audio_latency(pipeline.first_audio_at - pipeline.started)
+            return response
+        finally:
+            pipeline.end()
+
+    async def listen(self, prompt):
+        """Wait for enter (the reply may still be playing), then record and transcribe the answer."""
+        await ainput(prompt)
+        await self.stop_playback()
+        current_turn.set(current_turn.get() + 1)
+        self.recording_stop = threading.Event()
+        try:
+            return await asyncio.to_thread(listen, self.lang, self.options, self.recording_stop)
+        finally:
+            self.recording_stop = None
+
+    async def _play(self, pipeline):
+        """Wait for the pipeline to finish speaking; cancelling this task cuts it off (barge-in)."""
+        closing = asyncio.ensure_future(asyncio.to_thread(pipeline.wait))
+        try:
+            await asyncio.shield(closing)
+        except asyncio.CancelledError:
+            pipeline.cancel()
+            await closing
+            raise
+
+    async def stop_playback(self):
+        """Cut off the reply that is currently playing, if any."""
+        if self.playback is not None:
+            self.playback.cancel()
+            await self.finish_playback()
+
+    async def finish_playback(self):
+        """Wait for the reply that is currently playing to end."""
+        if self.playback is not None:
+            await asyncio.gather(self.playback, return_exceptions=True)
+            self.playback = None
+
+class WebSocketOutput:
+    """Audio output that streams reply segments to a remote learner instead of playing them.
+
+    Each reply is framed by "audio_start" and "audio_end" messages. Sends wait for the
+    connection to drain, so a slow client holds back only its own session's pipeline.
+    """
+
+    def __init__(self, websocket, loop):
+        self.websocket = websocket
+        self.loop = loop
+        self.stopped = threading.Event()
+
+    def send(self, message):
+        asyncio.run_coroutine_threadsafe(self.websocket.send(message), self.loop).result()
+
+    def play(self, segments):
+        self.stopped.clear()
+        with tracer.span("playback", backend="websocket") as span:
+            self.send(json.dumps({"type": "audio_start"}))
+            for segment in segments:
+                if self.stopped.is_set():
+                    break
+                self.send(segment)
+                span.add("bytes_sent", len(segment))
+            self.send(json.dumps({"type": "audio_end", "interrupted": self.stopped.is_set()}))
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        pass
+
+class RemoteSession(SessionEngine):
+    """A SessionEngine whose learner is a websocket client.
+
+    Replies are sent as text plus mp3 segments, and each answer arrives as one binary message
+    of encoded audio (anything Deepgram accepts, e.g. FLAC or Opus). Only one answer may be
+    pending at a time; the client sends {"type": "end"} to finish the lesson early.
+    """
+
+    handle_signals = False
+
+    def __init__(self, websocket, lang, options):
+        super().__init__(lang, options, WebSocketOutput(websocket, asyncio.get_running_loop()))
+        self.websocket = websocket
+        self.answers = asyncio.Queue(maxsize=1)
+
+    async def send(self, **message):
+        await self.websocket.send(json.dumps(message))
+
+    async def receive(self):
+        """Read client messages until the connection closes, queueing answers."""
+        try:
+            async for message in self.websocket:
+                if isinstance(message, bytes):
+                    try:
+                        self.answers.put_nowait(message)
+                    except asyncio.QueueFull:
+                        await self.send(type="error", message="An answer is already being processed")
+                elif json.loads(message).get("type") == "end":
+                    self.end()
+        finally:
+            self.end()
+
+    def end(self):
+        """End the turns if a lesson is running, otherwise stop waiting for answers."""
+        if self.turns_task is not None and not self.turns_task.done():
+            self.turns_task.cancel()
+        elif self.answers.empty():
+            self.answers.put_nowait(None)
+
+    async def tutor_turn(self, conversation, label, prepared=None):
+        response = await super().tutor_turn(conversation, label, prepared)
+        await self.send(type="tutor", text=response)
+        return response
+
+    async def listen(self, prompt):
+        await self.send(type="listen", prompt=re.sub(r"\x1b\[[0-9;]*m", "", prompt).strip())
+        audio = await self.answers.get()
+        if audio is None:
+            raise EOFError("the learner left")
+        await self.stop_playback()
+        current_turn.set(current_turn.get() + 1)
+        transcript = await asyncio.to_thread(speech_to_text, audio, self.lang)
+        await self.send(type="transcript", text=transcript)
+        return transcript
+
+session_output = contextvars.ContextVar("session_output", default=None)
+
+class SessionStdout:
+    """sys.stdout stand-in for server mode that sends each session's prints to that session's log."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        return (session_output.get() or self.stream).write(text)
+
+    def flush(self):
+        (session_output.get() or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class SessionServer:
+    """Hosts many concurrent lessons and diagnostic tests for remote learners in one process.
+
+    Sessions share the service clients' connection pools and the TTS cache; each has its own
+    conversation, user folder, log file and turn counter. Beyond `max_sessions`, new learners
+    are turned away rather than slowing everyone down.
+    """
+
+    USER_RE = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+    def __init__(self, users_dir, options, max_sessions=100):
+        self.users_dir = users_dir
+        self.options = options
+        self.max_sessions = max_sessions
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def handle(self, websocket):
+        """Run one learner's session: a "start" message, then the lesson or diagnostic turns."""
+        if self.active >= self.max_sessions:
+            await websocket.send(json.dumps({"type": "error", "message": "Server busy, try again later"}))
+            await websocket.close(1013, "server busy")  # 1013: try again later
+            return
+        self.active += 1
+        try:
+            start = json.loads(await asyncio.wait_for(websocket.recv(), timeout=30))
+            user, lang, level = str(start.get("user", "")), str(start.get("lang", "en")), str(start.get("level", "diagnostic"))
+            if start.get("type") != "start" or not self.USER_RE.match(user) or user.startswith("."):
+                raise ValueError("Expected {\"type\": \"start\", \"user\": ..., \"lang\": ..., \"level\": ...}")
+            # lang ends up in file paths (word lists, prepared lessons, the session log), so only known codes pass
+            if lang not in LANG_CODE_TO_NAME:
+                raise ValueError(f"Unsupported language code '{lang[:16]}'")
+            if level != "diagnostic" and not (level.isdigit() and 1 <= int(level) <= 10):
+                raise ValueError("Level must be 'diagnostic' or a number between 1 and 10")
+            await self.run_session(websocket, user, lang, level)
+            self.completed += 1
+        except (EOFError, websockets.ConnectionClosed):
+            self.failed += 1
+        except Exception as e:
+            self.failed += 1
+            try:
+                await websocket.send(json.dumps({"type": "error", "message": str(e)}))
+            except websockets.ConnectionClosed:
+                pass
+        finally:
+            self.active -= 1
+
+    async def run_session(self, websocket, user, lang, level):
+        user_folder = os.path.join(self.users_dir, user)
+        session = f"{datetime.now():%Y%m%d_%H%M%S}_{user}_{lang}_{level}"
+        log_dir = os.path.join(user_folder, "sessions")
+        os.makedirs(log_dir, exist_ok=True)
+        current_session.set(session)
+        engine = RemoteSession(websocket, lang, self.options)
+        with open(os.path.join(log_dir, f"{session}.log"), "a") as log:
+            session_output.set(log)
+            await engine.send(type="ready", session=session)
+            receiver = asyncio.create_task(engine.receive())
+            try:
+                if level == "diagnostic":
+                    level = await diagnostic_test_async(lang, user_folder, self.options, engine)
+                else:
+                    level = await generate_lesson_async(lang, int(level), user_folder, self.options, engine)
+                await engine.send(type="done", level=level)
+            finally:
+                receiver.cancel()
+
+async def serve(host, port, users_dir, options, max_sessions=100, max_answer_mb=8):
+    """Serve lessons to websocket clients until interrupted."""
+    loop = asyncio.get_running_loop()
+    # Each session keeps a few worker threads busy (STT, Claude, TTS, playback waits)
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=4 * max_sessions + 8))
+    sys.stdout = SessionStdout(sys.stdout)
+    resize_service_pools(max_sessions)
+    server = SessionServer(users_dir, options, max_sessions)
+    service_clients.warm_up_in_background()
+    async with websockets.serve(server.handle, host, port, max_size=max_answer_mb * 1024 * 1024):
+        print(f"Serving lessons on ws://{host}:{port} (up to {max_sessions} learners)")
+        await asyncio.Future()
 
 def print_colored_response(response):
     """Print the response with colorized square bracket translations."""
-    parts = re.split(r'(\[[^\]]*\])', response)
-    for i, part in enumerate(parts):
-        if i % 2 == 0:
-            print(part, end='')
-        else:
-            print(f"{Fore.MAGENTA}{part}{Style.RESET_ALL}", end='')
+    print_colored_chunk(response)
     print()  # New line at the end
 
-class ArgumentParser(Tap):
-    lang: str = "en"  # Language code for text-to-speech
-    level: str = "diagnostic"  # Level: 'diagnostic' or 1-10
-    user: str  # User folder name for storing progress
+def print_colored_chunk(chunk, in_brackets=False):
+    """Print part of a response, colorizing square brackets that may span chunks.
+
+    Returns whether the text following this chunk is still inside brackets.
+    """
+    for part in re.split(r'(\[|\])', chunk):
+        if part == '[':
+            in_brackets = True
+        if in_brackets and part:
+            print(f"{Fore.MAGENTA}{part}{Style.RESET_ALL}", end='')
+        else:
+            print(part, end='')
+        if part == ']':
+            in_brackets = False
+    sys.stdout.flush()
+    return in_brackets
 
 def main(args):
     """Main loop."""
-    language = LANG_CODE_TO_NAME.get(args.lang, "Unknown language")
-
-    if args.level == "diagnostic":
-        print(f"Starting diagnostic test for {language}...")
-        level = diagnostic_test(args.lang, args.user)
-        print(f"Your proficiency level in {language} is: {level}/10")
-    elif args.level.isdigit() and 1 <= int(args.level) <= 10:
-        level = int(args.level)
-        print(f"Starting a level {level} lesson in {language}...")
-        generate_lesson(args.lang, level, args.user)
-    else:
+    global tts_cache, llm_cache, audio_output
+    if args.migrate_progress:
+        migrate_progress_folders(args.migrate_progress)
+        return
+    if args.recompute_progress:
+        try:
+            configure_stage_policies(args.policy)
+        except ValueError as e:
+            print(e)
+            return
+        ProgressRecompute(args.recompute_progress).run(args.recompute_mode, args.recompute_concurrency, args.batch_poll)
+        return
+    if not args.serve and not args.user:
+        print("Please choose a user folder with --user.")
+        return
+    if not args.serve and not (args.level == "diagnostic" or (args.level.isdigit() and 1 <= int(args.level) <= 10)):
         print("Invalid level. Please use 'diagnostic' or a number between 1 and 10.")
         return
+    try:
+        configure_stage_policies(args.policy)
+    except ValueError as e:
+        print(e)
+        return
+    if not args.serve:
+        # Load the SDKs and connect to the services while the session sets up
+        service_clients.warm_up_in_background()
+
+    language = LANG_CODE_TO_NAME.get(args.lang, "Unknown language")
+    options = SessionOptions(stream=args.stream, capture=args.capture, audio_format=args.audio_format,
+                             stt=args.stt, prompt_cache=not args.no_prompt_cache,
+                             context_budget=args.context_budget, auto_stop=args.auto_stop,
+                             silence_hangover=args.silence_hangover, prefetch=args.prefetch)
+    tts_cache = AudioCache(os.path.join(args.cache_dir or DEFAULT_CACHE_DIR, "tts"), args.tts_cache_mb * 1024 * 1024)
+    llm_cache = ResponseCache(os.path.join(args.cache_dir or DEFAULT_CACHE_DIR, "llm.sqlite3"), args.llm_cache,
+                              args.llm_cache_variants, args.llm_cache_days * 24 * 3600, args.llm_cache_mb * 1024 * 1024)
+    audio_output = make_audio_output(args.player, args.player_file)
+    if args.trace or args.trace_dir or args.trace_otel:
+        session = "server" if args.serve else f"{args.lang}_{args.level}"
+        tracer.open(args.trace_dir, f"{datetime.now():%Y%m%d_%H%M%S}_{session}", args.trace_otel)
 
-    print("Lesson complete. Thank you for learning with us!")
+    try:
+        if args.serve:
+            try:
+                asyncio.run(serve(args.host, args.port, args.users_dir, options, args.max_sessions))
+            except KeyboardInterrupt:
+                print("Server stopped.")
+            return
+
+        if args.level == "diagnostic":
+            print(f"Starting diagnostic test for {language}...")
+            level = diagnostic_test(args.lang, args.user, options)
+            print(f"Your proficiency level in {language} is: {level}/10")
+        else:
+            level = int(args.level)
+            print(f"Starting a level {level} lesson in {language}...")
+            generate_lesson(args.lang, level, args.user, options)
+
+        print("Lesson complete. Thank you for learning with us!")
+        print_session_stats()
+    finally:
+        audio_output.close()
+        if tracer.enabled:
+            tracer.print_summary()
+            tracer.close()
+
+def print_session_stats():
+    """Print cache and connection-pool counters for this session."""
+    stats = tts_cache.stats()
+    print(f"{Style.DIM}TTS cache: {stats['hits']} hits, {stats['misses']} misses "
+          f"({stats['hit_rate']:.0%} hit rate), {stats['evictions']} evictions{Style.RESET_ALL}")
+    if llm_cache.sites:
+        stats = llm_cache.stats()
+        sites = ", ".join(f"{site} {site_stats['hit_rate']:.0%}" for site, site_stats in stats["sites"].items())
+        print(f"{Style.DIM}Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate; {sites}), "
+              f"{stats['expirations']} expired, {stats['evictions']} evictions{Style.RESET_ALL}")
+
+    pools = service_clients.stats()
+    for service in ("anthropic", "deepgram", "gtts"):
+        counters = ", ".join(f"{value} {name.replace('_', ' ')}" for name, value in pools[service].items())
+        print(f"{Style.DIM}{service} pool: {counters}{Style.RESET_ALL}")
+
+    for stage, calls in stage_calls.items():
+        counters = ", ".join(f"{value} {name.replace('_', ' ')}" for name, value in sorted(calls.stats().items()))
+        print(f"{Style.DIM}{stage} calls: {counters or 'none'} (hedging after {calls.hedge_delay():.2f}s){Style.RESET_ALL}")
 
 if __name__ == "__main__":
+    # Command line arguments live in a small module because Tap parses the defining module's source for help text;
+    # importing it here keeps Tap out of `import talko`
+    from talko_args import ArgumentParser
     args = ArgumentParser().parse_args()
     main(args)
 
@@ -0,0 +1,44 @@
+"""Command line arguments for talko.py.
+
+Tap reads the help text from the comments in this class's source, so it lives in its own small
+module: parsing all of talko.py for them would add a noticeable delay to every start.
+"""
+from typing import List, Literal
+
+from tap import Tap
+
+class ArgumentParser(Tap):
+    lang: str = "en"  # Language code for text-to-speech
+    level: str = "diagnostic"  # Level: 'diagnostic' or 1-10
+    user: str = ""  # User folder name for storing progress
+    stream: bool = False  # Stream Claude's replies and speak them sentence by sentence
+    capture: Literal["memory", "file"] = "memory"  # Keep recordings in memory or write recording.wav
+    audio_format: Literal["flac", "opus"] = "flac"  # Upload format for in-memory recordings
+    stt: Literal["prerecorded", "live"] = "prerecorded"  # Transcribe after recording, or live while speaking
+    prefetch: bool = False  # Prepare the next lesson after each session, so it starts instantly
+    no_prompt_cache: bool = False  # Don't use Anthropic prompt caching
+    context_budget: int = 8000  # Summarize older turns once a request exceeds this many input tokens (0 disables)
+    auto_stop: bool = False  # Stop recording automatically once you pause (Ctrl+C still works)
+    silence_hangover: float = 1.0  # Seconds of silence that end a recording with --auto_stop
+    cache_dir: str = ""  # Directory for cached audio (default: $TALKO_CACHE_DIR or ~/.cache/talko)
+    tts_cache_mb: int = 200  # Size budget for cached TTS audio in MB (0 disables the cache)
+    llm_cache: List[Literal["diagnostic", "topic"]] = []  # Call sites whose Claude replies may be reused across sessions: the diagnostic test's opening, lesson topics
+    llm_cache_variants: int = 3  # Replies kept per cached request; once there are this many, a random one is reused
+    llm_cache_days: float = 7.0  # Days a cached reply is reused before it expires
+    llm_cache_mb: int = 20  # Size budget for cached replies in MB
+    migrate_progress: str = ""  # Import progress JSON files of every user folder under this directory, then exit
+    recompute_progress: str = ""  # Re-evaluate the latest progress of every user folder under this directory with the current prompt, then exit
+    recompute_mode: Literal["batch", "pool"] = "batch"  # Send --recompute_progress requests as Message Batches (half price, slower) or directly
+    recompute_concurrency: int = 8  # Requests in flight at once with --recompute_mode pool
+    batch_poll: float = 30.0  # Seconds between Message Batch status checks with --recompute_progress
+    player: Literal["sounddevice", "command", "null", "file"] = "sounddevice"  # Play speech in-process, with afplay, not at all, or into --player_file
+    player_file: str = "playback.wav"  # WAV file written by --player file
+    trace: bool = False  # Time each stage and print a latency summary at the end of the session
+    trace_dir: str = ""  # Also write the session's trace spans as JSONL to this directory
+    trace_otel: bool = False  # Also export trace spans through the configured OpenTelemetry tracer provider
+    serve: bool = False  # Serve lessons to many remote learners over websockets instead of running one locally
+    host: str = "127.0.0.1"  # Address to serve on with --serve
+    port: int = 8765  # Port to serve on with --serve
+    users_dir: str = "users"  # Directory holding each remote learner's user folder with --serve
+    max_sessions: int = 100  # Learners served at once with --serve; more are turned away
+    policy: List[str] = []  # Timeout/retry/hedging overrides per stage, e.g. llm.timeout=20 tts.hedge_after=0.8 stt.hedge=true
@@ -0,0 +1,78 @@
+import numpy as np
+
+from talko import STT_SAMPLE_RATE, SpeechEndpointer
+
+BLOCK = 1024
+
+
+def noise(seconds, db, seed=0):
+    """White noise at the given RMS level in dBFS."""
+    samples = np.random.default_rng(seed).standard_normal(int(seconds * STT_SAMPLE_RATE))
+    return (samples * 10 ** (db / 20)).astype(np.float32)
+
+
+def speech(seconds, db=-20.0):
+    """A voiced, syllable-like signal: a 200 Hz tone with a 4 Hz amplitude envelope."""
+    t = np.arange(int(seconds * STT_SAMPLE_RATE)) / STT_SAMPLE_RATE
+    envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * t)
+    return (np.sin(2 * np.pi * 200 * t) * envelope * 10 ** (db / 20) * np.sqrt(2)).astype(np.float32)
+
+
+def feed(endpointer, audio):
+    """Feed audio in microphone-sized blocks; return the sample count at which recording stopped, or None."""
+    endpointer.start(STT_SAMPLE_RATE)
+    for start in range(0, len(audio), BLOCK):
+        if endpointer.process(audio[start:start + BLOCK]):
+            return start + BLOCK
+    return None
+
+
+def test_stops_after_hangover():
+    audio = np.concatenate([noise(0.5, -70), speech(1.0) + noise(1.0, -70, 1), noise(2.0, -70, 2)])
+    stopped = feed(SpeechEndpointer(hangover=1.0), audio)
+    assert stopped is not None
+    assert 2.4 <= stopped / STT_SAMPLE_RATE <= 2.7
+
+
+def test_speech_from_the_first_frame():
+    audio = np.concatenate([speech(1.0), noise(2.0, -70)])
+    stopped = feed(SpeechEndpointer(hangover=1.0), audio)
+    assert stopped is not None
+    assert stopped / STT_SAMPLE_RATE <= 2.2
+
+
+def test_trims_leading_and_trailing_silence():
+    audio = np.concatenate([noise(1.0, -70), speech(1.0), noise(1.5, -70, 1)])
+    endpointer = SpeechEndpointer(hangover=1.0, padding=0.2)
+    feed(endpointer, audio)
+    start, end = endpointer.speech_span(len(audio))
+    assert abs(start / STT_SAMPLE_RATE - 0.8) < 0.05
+    assert abs(end / STT_SAMPLE_RATE - 2.2) < 0.05
+
+
+def test_silence_only_keeps_recording():
+    audio = noise(3.0, -70)
+    endpointer = SpeechEndpointer(hangover=1.0)
+    assert feed(endpointer, audio) is None
+    assert endpointer.speech_span(len(audio)) == (0, len(audio))
+
+
+def test_short_click_is_not_speech():
+    audio = np.concatenate([noise(0.5, -70), speech(0.05), noise(2.0, -70, 1)])
+    assert feed(SpeechEndpointer(hangover=1.0, min_speech=0.15), audio) is None
+
+
+def test_unvoiced_speech_after_steady_noise():
+    # Quiet hiss just above the floor counts as speech because of its zero-crossing rate
+    audio = np.concatenate([noise(1.0, -75), noise(0.5, -54, 1), noise(2.0, -75, 2)])
+    assert feed(SpeechEndpointer(hangover=1.0), audio) is not None
+
+
+def test_steady_hiss_before_speech_becomes_the_floor():
+    # Room noise loud enough for the zero-crossing rule at first must not end or start the utterance on its own
+    audio = np.concatenate([noise(1.0, -54), speech(1.0) + noise(1.0, -54, 1), noise(2.0, -54, 2)])
+    endpointer = SpeechEndpointer(hangover=1.0)
+    stopped = feed(endpointer, audio)
+    assert stopped is not None
+    assert 2.9 <= stopped / STT_SAMPLE_RATE <= 3.2
+    assert endpointer.speech_span(len(audio))[0] / STT_SAMPLE_RATE >= 0.7